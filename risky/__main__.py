@@ -2,6 +2,8 @@
 
 import concurrent.futures
 import functools
+import hashlib
+import importlib
 import json
 import os
 import os.path
@@ -9,24 +11,10 @@ import subprocess
 import sys
 import tempfile
 import traceback
+import warnings
 
-import risky.cpu
-import risky.demo
-import risky.loader
-import risky.old_cpu
-import risky.ormux_cpu
-import risky.soc
-import risky.test
-import risky.test.rv32i
-import risky.test.plain
-
-import amaranth as am
-import amaranth.sim
-import amaranth.back.verilog
-
-import amaranth_boards.de10_nano
-import amaranth_boards.icestick
-import amaranth_boards.tang_nano_9k
+# risky and amaranth imports are done inside the commands that use them,
+# since importing all of amaranth makes even --help slow
 
 import click
 import tqdm
@@ -44,13 +32,47 @@ def unbuffer_stdout():
 def cli():
     pass
 
+# runs in a worker process, so it must be a picklable top-level function.
+# amaranth objects don't pickle well, so we get a way to build a cpu
+# and the test class, and construct everything on the other side.
+# returns None on success, or the formatted traceback on failure, so
+# that one failing test doesn't take the rest of its batch with it
+def _run_test(make_cpu, test_class, compiler_dir=None, engine=None):
+    try:
+        test = test_class(make_cpu(), compiler_dir=compiler_dir, engine=engine)
+        test.run()
+    except Exception:
+        return traceback.format_exc()
+
+def _run_tests(make_cpu, test_classes, compiler_dir=None, engine=None):
+    return [_run_test(make_cpu, test_class, compiler_dir, engine) for test_class in test_classes]
+
+def _new_cpu(extension_classes):
+    # extensions hold signals once a cpu prepares them, so every cpu
+    # gets fresh ones, made here rather than pickled over from the parent
+    import risky.cpu
+    return risky.cpu.Cpu(extensions=[e() for e in extension_classes])
+
 @cli.command()
 @click.option('-c', '--cpu-name')
 @click.option('-i', '--instruction-name')
-def test(cpu_name, instruction_name):
+@click.option('--sim-backend', type=str, default='pysim')
+def test(cpu_name, instruction_name, sim_backend):
+    import amaranth as am
+    import amaranth.sim
+
+    import risky.cpu
+    import risky.old_cpu
+    import risky.ormux_cpu
+    import risky.test
+    import risky.test.header
+    import risky.test.memory
+    import risky.test.refmodel
+    import risky.test.rv32i
+    import risky.test.zicntr
+
     def iter_configs():
-        cpu = risky.old_cpu.Cpu()
-        yield ('old-' + cpu.march, cpu)
+        yield ('old-', risky.old_cpu.Cpu)
 
         configs = [
             [],
@@ -58,8 +80,10 @@ def test(cpu_name, instruction_name):
         ]
 
         for config in configs:
-            cpu = risky.cpu.Cpu(extensions=[e() for e in config])
-            yield ('new-' + cpu.march, cpu)
+            yield ('new-', functools.partial(_new_cpu, config))
+
+        # the same core behind its simple bus, bridged back by the soc
+        yield ('new-simple-', functools.partial(risky.cpu.Cpu, simple_bus=True))
 
         configs = [
             [],
@@ -67,37 +91,77 @@ def test(cpu_name, instruction_name):
         ]
 
         for config in configs:
-            cpu = risky.ormux_cpu.Cpu(extensions=config)
-            yield('ormux-' + cpu.march, cpu)
+            yield ('ormux-', functools.partial(risky.ormux_cpu.Cpu, extensions=config))
+
+    # check the engine once here, rather than failing every test with it
+    try:
+        am.sim.Simulator(am.Module(), engine=sim_backend)
+    except (TypeError, ValueError, ImportError) as e:
+        raise click.BadParameter(str(e), param_hint='--sim-backend')
+
+    # the cpus we build here are only used for names and test discovery,
+    # the workers build (and elaborate) their own
+    warnings.simplefilter('ignore', am.hdl.UnusedElaboratable)
 
     total = 0
     fails = []
-    executor = concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count())
-    for name, cpu in iter_configs():
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=os.cpu_count())
+
+    # one scratch directory for every test compile, cleaned up all at once
+    compiler_dir = tempfile.TemporaryDirectory(prefix='risky-test.')
+    for prefix, make_cpu in iter_configs():
+        cpu = make_cpu()
+        name = prefix + cpu.march
         if cpu_name and name != cpu_name:
             continue
 
         print()
         print(name)
-        tests = list(risky.test.ProgramTest.iter_tests(cpu, filter=lambda t: instruction_name is None or t.name == instruction_name))
-        with tqdm.tqdm(total=len(tests), unit='t') as pbar:
-            results = [executor.submit(lambda t: t.run(), test) for test in tests]
-            for test, result in zip(tests, results):
-                pbar.desc = test.name
-                pbar.update(0)
-
+        tests = risky.test.ProgramTest.iter_tests(cpu, filter=lambda t: instruction_name is None or t.name == instruction_name)
+        with tqdm.tqdm(total=0, unit='t') as pbar:
+            # batch tests up, so we don't pay for a round trip per test.
+            # the number of test classes is an upper bound on the count
+            chunksize = max(1, len(risky.test.ProgramTest.__subclasses__()) // (os.cpu_count() * 4))
+            batches = {}
+
+            def submit(batch):
+                result = executor.submit(_run_tests, make_cpu, [t.__class__ for t in batch], compiler_dir.name, sim_backend)
+                batches[result] = batch
+                pbar.total += len(batch)
+                pbar.refresh()
+
+            # submit while discovering, so the workers start right away
+            batch = []
+            for t in tests:
+                batch.append(t)
+                if len(batch) >= chunksize:
+                    submit(batch)
+                    batch = []
+            if batch:
+                submit(batch)
+
+            # handle batches as they finish, not in submission order
+            for result in concurrent.futures.as_completed(batches):
+                batch = batches[result]
                 try:
-                    result.result()
-                except Exception as e:
-                    fails.append((name, test.name))
-                    print()
-                    print()
-                    print('!!! ', name, test.name)
-                    traceback.print_exc()
-                    print()
-
-                total += 1
-                pbar.update(1)
+                    errors = result.result()
+                except Exception:
+                    # the worker itself died, not just the tests
+                    errors = [traceback.format_exc()] * len(batch)
+
+                for test, error in zip(batch, errors):
+                    pbar.desc = test.name
+                    pbar.update(0)
+
+                    if error:
+                        fails.append((name, test.name))
+                        print()
+                        print()
+                        print('!!! ', name, test.name)
+                        print(error)
+
+                    total += 1
+                    pbar.update(1)
 
             pbar.desc = ''
             pbar.update(0)
@@ -107,6 +171,9 @@ def test(cpu_name, instruction_name):
             # that we never elaborate them.
             break
 
+    executor.shutdown()
+    compiler_dir.cleanup()
+
     print()
     print('{} tests, {} failures.'.format(total, len(fails)))
     for cpu_name, test_name in fails:
@@ -120,35 +187,138 @@ def test(cpu_name, instruction_name):
 @click.option('-g', '--gtk-wave', type=click.File('w'))
 @click.option('--cycles', type=int)
 @click.option('--boot/--no-boot', is_flag=True, default=True)
+@click.option('-t', '--trace', 'traces', multiple=True)
 @click.argument('sources', nargs=-1, required=True)
-def simulate(output, gtk_wave, cycles, sources, boot):
-    plain = risky.test.plain.Plain(sources, cycles=cycles, boot=boot)
+def simulate(output, gtk_wave, cycles, sources, boot, traces):
+    import risky.test.plain
+
+    plain = risky.test.plain.Plain(sources, cycles=cycles, boot=boot, trace_categories=set(traces) or None)
     unbuffer_stdout()
     plain.run(output=output, gtkw_file=gtk_wave)
 
+@cli.command()
+@click.option('--cycles', type=int)
+@click.option('--boot/--no-boot', is_flag=True, default=True)
+@click.option('--build-dir', default='build-verilator')
+@click.argument('sources', nargs=-1, required=True)
+def verilate(cycles, boot, build_dir, sources):
+    # like simulate, but compiled with verilator, and without input
+    import risky.soc
+    import risky.test.verilator
+
+    soc = risky.soc.Soc.with_autodetect(risky.test.verilator.Verilated.clk_freq, *sources)
+    sim = risky.test.verilator.Verilated(optimized_convert(soc, flatten=True), build_dir)
+
+    print('building...')
+    sim.build()
+
+    unbuffer_stdout()
+    sim.run(cycles=cycles, boot=boot)
+
 @cli.command()
 @click.option('-o', '--output', type=click.File('w'), default='-')
 def memory_x(output):
+    import risky.soc
+
     soc = risky.soc.Soc(1_000_000)
     output.write(soc.generate_memory_x())
 
 @cli.command()
 @click.option('-o', '--output', type=click.File('w'), default='-')
 def header(output):
+    import risky.soc
+
     soc = risky.soc.Soc(1_000_000)
     output.write(soc.generate_header())
 
 @cli.command()
 @click.option('-o', '--output', type=click.File('w'), default='-')
 def svd(output):
+    import risky.soc
+
     soc = risky.soc.Soc(1_000_000)
     output.write(soc.generate_svd())
 
+def find_optimizing_yosys():
+    from amaranth._toolchain.yosys import find_yosys
+
+    return find_yosys(lambda ver: ver >= (0, 40))
+
+def optimized_convert(top, flatten=False):
+    # like amaranth.back.verilog.convert, but with yosys' cleanup passes
+    # run first, which merge the many small cells amaranth emits.
+    # flatten merges the hierarchy too, so they work across modules
+    import amaranth.back.rtlil
+
+    rtlil = amaranth.back.rtlil.convert(top)
+    yosys = find_optimizing_yosys()
+    script = [
+        'read_rtlil <<rtlil\n{}\nrtlil'.format(rtlil),
+        'proc',
+        *(['flatten'] if flatten else []),
+        'opt_expr',
+        'opt_merge -share_all',
+        'opt_clean',
+        'opt_dff',
+        'write_verilog -norename',
+    ]
+
+    return yosys.run(['-q', '-'], '\n'.join(script), ignore_warnings=True)
+
+def cached_convert(make_top, key, optimize=False):
+    # conversion is slow, and the result only depends on the key, the
+    # toolchain, and the code that generated it, so keep it on disk
+    # named by all of those. make_top is only called on a miss, since
+    # anything built and never elaborated makes amaranth complain
+    import amaranth
+    import amaranth.back.verilog
+    import amaranth_soc
+
+    import risky.compiler
+
+    toolchain = [amaranth.__version__, amaranth_soc.__version__]
+    if optimize:
+        toolchain.append(find_optimizing_yosys().version())
+
+    h = hashlib.blake2b(repr((toolchain, key, optimize)).encode('utf-8'), digest_size=16)
+    here = os.path.dirname(os.path.abspath(__file__))
+    for name in sorted(os.listdir(here)):
+        if name.endswith('.py'):
+            with open(os.path.join(here, name), 'rb') as f:
+                h.update(name.encode('utf-8'))
+                h.update(f.read())
+
+    path = risky.compiler.cache_path('verilog', h.hexdigest() + '.v')
+    try:
+        with open(path) as f:
+            return f.read()
+    except FileNotFoundError:
+        pass
+
+    top = make_top()
+    if optimize:
+        result = optimized_convert(top)
+    else:
+        result = amaranth.back.verilog.convert(top)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmppath = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmppath, 'w') as f:
+        f.write(result)
+    os.replace(tmppath, path)
+
+    return result
+
 @cli.command()
 @click.option('-o', '--output', type=click.File('w'), default='-')
-def verilog(output):
-    top = risky.ormux_cpu.Cpu()
-    output.write(am.back.verilog.convert(top))
+@click.option('-O', '--optimize', is_flag=True)
+def verilog(output, optimize):
+    import risky.ormux_cpu
+
+    cpu = risky.ormux_cpu.Cpu
+    extensions = []
+    key = (cpu.__module__, cpu.__qualname__, tuple(e.__qualname__ for e in extensions))
+    output.write(cached_convert(functools.partial(cpu, extensions), key, optimize=optimize))
 
 @cli.command()
 @click.argument('port')
@@ -156,6 +326,9 @@ def verilog(output):
 @click.option('-a', '--attach', is_flag=True)
 @click.argument('sources', nargs=-1, required=True)
 def load(port, baud, attach, sources):
+    import risky.loader
+    import risky.soc
+
     soc = risky.soc.Soc.with_autodetect(1_000_000, *sources)
     boot = risky.loader.Bootloader(port, baud=baud)
 
@@ -182,12 +355,17 @@ def load(port, baud, attach, sources):
     if attach:
         boot.attach()
 
+# resolved with importlib in demo(), so they are only imported when used
 BOARDS = {
-    'de10-nano': amaranth_boards.de10_nano.DE10NanoPlatform,
-    'icestick': amaranth_boards.icestick.ICEStickPlatform,
-    'tang-nano-9k': amaranth_boards.tang_nano_9k.TangNano9kPlatform,
+    'de10-nano': 'amaranth_boards.de10_nano.DE10NanoPlatform',
+    'icestick': 'amaranth_boards.icestick.ICEStickPlatform',
+    'tang-nano-9k': 'amaranth_boards.tang_nano_9k.TangNano9kPlatform',
 }
 
+def resolve_board(board):
+    module, name = BOARDS[board].rsplit('.', 1)
+    return getattr(importlib.import_module(module), name)
+
 @cli.command()
 @click.option('--board', '-b', type=click.Choice(sorted(BOARDS.keys()), case_sensitive=False), default='icestick')
 @click.option('--generate', '-g', is_flag=True)
@@ -212,7 +390,9 @@ def demo(board, generate, archive, build_dir, program, toolchain, topname, ssh,
             hostname=ssh,
         )
 
-    BoardPlatform = BOARDS[board]
+    import risky.demo
+
+    BoardPlatform = resolve_board(board)
     demo = risky.demo.Demo(sources)
 
     platform_kwargs = dict()
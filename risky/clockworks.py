@@ -13,7 +13,10 @@ class Clockworks(am.Elaboratable):
         self.divisor = (int(in_freq) // 2) // out_freq
         self.out_freq = (in_freq / self.divisor) / 2
 
-        self.count = am.Signal(am.Shape.cast(range(self.divisor)).width + 1)
+        # count down, with a separate borrow bit that is set when the
+        # count goes below zero
+        self.count = am.Signal(max(1, (self.divisor - 1).bit_length()))
+        self.borrow = am.Signal()
         self.domain = am.ClockDomain(name)
 
     def elaborate(self, platform):
@@ -21,13 +24,13 @@ class Clockworks(am.Elaboratable):
 
         m.domains += self.domain
 
-        with m.If(self.count[-1]):
+        with m.If(self.borrow):
             # -2 because we count from divisor - 2 to -1, inclusive
             # which is divisor counts total
-            m.d.sync += self.count.eq(self.divisor - 2)
+            m.d.sync += am.Cat(self.count, self.borrow).eq(self.divisor - 2)
             m.d.sync += self.domain.clk.eq(~self.domain.clk)
         with m.Else():
-            m.d.sync += self.count.eq(self.count - 1)
+            m.d.sync += am.Cat(self.count, self.borrow).eq(self.count - 1)
 
         m.d.comb += self.domain.rst.eq(am.ResetSignal())
 
@@ -1,38 +1,109 @@
+import array
+import concurrent.futures
+import functools
 import hashlib
 import io
+import os
 import os.path
-import struct
 import subprocess
+import sys
 import tempfile
+import uuid
 
+import elftools.elf.constants
 import elftools.elf.elffile
 import importlib_resources
 
+# the runtime objects only depend on the compiler flags and the runtime
+# sources, so they are built once and shared between every Compiler
+_runtime_objects = {}
+
+def cache_path(*components):
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(base, 'risky', *components)
+
+@functools.lru_cache(maxsize=None)
+def _load_runtime(name):
+    return importlib_resources.files('risky.runtime').joinpath(name).read_text()
+
+@functools.lru_cache(maxsize=None)
+def _runtime_dir():
+    # write the runtime files out once, into a directory named by their
+    # contents, so every Compiler can point gcc at them without copying
+    runtime = importlib_resources.files('risky.runtime')
+    names = sorted(f.name for f in runtime.iterdir() if f.is_file())
+
+    h = hashlib.blake2b(digest_size=8)
+    for name in names:
+        h.update(name.encode('utf-8'))
+        h.update(_load_runtime(name).encode('utf-8'))
+
+    d = cache_path('runtime', 'src-' + h.hexdigest())
+    if not os.path.isdir(d):
+        os.makedirs(os.path.dirname(d), exist_ok=True)
+        tmpd = tempfile.mkdtemp(prefix='src.', dir=os.path.dirname(d))
+        for name in names:
+            with open(os.path.join(tmpd, name), 'w') as f:
+                f.write(_load_runtime(name))
+
+        try:
+            os.rename(tmpd, d)
+        except OSError:
+            # someone else got there first, and theirs is identical
+            for name in names:
+                os.remove(os.path.join(tmpd, name))
+            os.rmdir(tmpd)
+
+    return d
+
+def _run(args, stdout=subprocess.DEVNULL, quiet=False):
+    # hold on to stderr, and pass it along, unless quiet, in which case
+    # only show it if something went wrong. that's for the cached
+    # runtime builds, whose warnings are nobody's business.
+    # close_fds=False skips closing every inherited fd in the child
+    p = subprocess.run(args, stdout=stdout, stderr=subprocess.PIPE, close_fds=False, text=True)
+    if p.stderr and (p.returncode != 0 or not quiet):
+        sys.stderr.write(p.stderr)
+    if p.returncode != 0:
+        raise subprocess.CalledProcessError(p.returncode, args, p.stdout, p.stderr)
+    return p
+
 class Compiler:
     RUNTIME_FILES = ['crt0.s']
-    EXTRA_FILES = ['csr.h']
 
-    def __init__(self, runtime=True, optimize=True, march='rv32i', mabi='ilp32'):
+    def __init__(self, runtime=True, optimize=True, march='rv32i', mabi='ilp32', parent_dir=None):
         self.runtime = importlib_resources.files('risky.runtime')
-        self.d = tempfile.TemporaryDirectory(prefix='risky-compiler.')
+        if parent_dir is None:
+            self.d = tempfile.TemporaryDirectory(prefix='risky-compiler.')
+            self.dir = self.d.name
+        else:
+            # whoever owns parent_dir is responsible for cleaning it up
+            self.d = None
+            self.dir = os.path.join(parent_dir, 'risky-compiler.' + uuid.uuid4().hex)
+            os.mkdir(self.dir)
+
+        self.march = march
+        self.mabi = mabi
+        self.optimize = optimize
 
         self.gcc = [
             'riscv-none-elf-gcc',
             '-march=' + march,
             '-mabi=' + mabi,
-            '-L', self.d.name,
-            '-I', self.d.name,
+            '-L', self.dir,
+            '-I', self.dir,
+            '-I', _runtime_dir(),
         ]
 
         if optimize:
             #self.gcc.append('-O3')
             self.gcc.append('-Os')
 
-        self.linkerscript = self.copy_runtime_file('link.x')
-        for name in self.EXTRA_FILES:
-            self.copy_runtime_file(name)
+        self.linkerscript = self.runtime_file('link.x')
 
         self.objectpaths = []
+        self.runtime_paths = []
+        self._pending = []
         if runtime:
             self.add_runtime()
 
@@ -41,12 +112,13 @@ class Compiler:
 
     def __exit__(self, exc_type, exc_value, traceback):
         try:
-            self.d.cleanup()
+            if self.d is not None:
+                self.d.cleanup()
         finally:
             pass
 
     def path(self, *components):
-        return os.path.join(self.d.name, *components)
+        return os.path.join(self.dir, *components)
 
     def include(self, fname):
         with open(fname) as src:
@@ -58,45 +130,112 @@ class Compiler:
             f.write(data)
 
     def add(self, fname):
+        # actual compilation is deferred to link(), so it can run in parallel
         os.makedirs(self.path('objects'), exist_ok=True)
         outpath = self.path('objects', os.path.split(fname)[1] + '.o')
-        subprocess.run(self.gcc + [
-            '-c', fname,
-            '-o', outpath,
-        ], check=True)
+        self._pending.append((fname, outpath))
         self.objectpaths.append(outpath)
 
-    def add_source(self, ext, source):
-        hash = hashlib.sha1(source.encode('utf-8')).hexdigest()
+    def _compile_all(self):
+        pending, self._pending = self._pending, []
+        if not pending:
+            return
+
+        def compile_one(fname, outpath):
+            _run(self.gcc + [
+                '-c', fname,
+                '-o', outpath,
+            ])
+
+        # gcc is an external process, so threads are enough here
+        with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            results = [executor.submit(compile_one, fname, outpath) for fname, outpath in pending]
+            for result in results:
+                result.result()
+
+    def write_source(self, ext, source):
+        hash = hashlib.blake2b(source.encode('utf-8'), digest_size=16).hexdigest()
         fname = self.path(hash + '.' + ext)
         with open(fname, 'w') as f:
             f.write(source)
-        self.add(fname)
+        return fname
+
+    def add_source(self, ext, source):
+        self.add(self.write_source(ext, source))
+
+    def runtime_file(self, name):
+        return os.path.join(_runtime_dir(), name)
 
     def copy_runtime_file(self, name):
         path = self.path(name)
         with open(path, 'w') as f:
-            src = self.runtime.joinpath(name).read_text()
-            f.write(src)
+            f.write(_load_runtime(name))
         return path
 
     def add_runtime(self):
         for name in self.RUNTIME_FILES:
-            path = self.copy_runtime_file(name)
-            self.add(path)
+            self.runtime_paths.append(self.runtime_file(name))
+
+        self.objectpaths.extend(self.runtime_objects())
+
+    def runtime_objects(self):
+        key = (self.march, self.mabi, self.optimize)
+        try:
+            return _runtime_objects[key]
+        except KeyError:
+            pass
+
+        # name the cache by the sources too, so edits invalidate it
+        h = hashlib.blake2b(repr(key).encode('utf-8'), digest_size=8)
+        for name in self.RUNTIME_FILES:
+            h.update(_load_runtime(name).encode('utf-8'))
+
+        d = cache_path('runtime', '{}-{}-{}'.format(self.march, self.mabi, h.hexdigest()))
+        os.makedirs(d, exist_ok=True)
+
+        paths = []
+        for name in self.RUNTIME_FILES:
+            outpath = os.path.join(d, name + '.o')
+            if not os.path.exists(outpath):
+                # other processes may be doing this at the same time,
+                # so build it elsewhere and move it into place
+                tmppath = '{}.{}.tmp'.format(outpath, os.getpid())
+                _run(self.gcc + [
+                    '-c', self.runtime_file(name),
+                    '-o', tmppath,
+                ], quiet=True)
+                os.replace(tmppath, outpath)
+
+            paths.append(outpath)
+
+        _runtime_objects[key] = paths
+        return paths
 
     def link(self):
+        self._compile_all()
+        return self._link(self.objectpaths)
+
+    def build_single_shot(self, sources):
+        # compile and link everything in one gcc invocation. anything
+        # passed to add() and not yet compiled goes in as a source too,
+        # and the runtime goes in as its sources, not its cached objects
+        pending = {outpath: fname for fname, outpath in self._pending}
+        runtime = set(self.runtime_objects()) if self.runtime_paths else set()
+        inputs = [pending.get(path, path) for path in self.objectpaths if path not in runtime]
+        return self._link([*sources, *inputs, *self.runtime_paths])
+
+    def _link(self, inputs):
         elfpath = self.path('program.elf')
-        subprocess.run(self.gcc + [
+        _run(self.gcc + [
             '-static',
             '-nostartfiles',
             '-static-libgcc',
-            *self.objectpaths,
+            *inputs,
             '-o', elfpath,
             '-T', self.linkerscript,
             '-Wl,--gc-sections',
             '-Wl,-m,elf32lriscv', # FIXME why?
-        ], check=True)
+        ])
 
         return ElfData.from_file(elfpath)
 
@@ -105,6 +244,8 @@ class ElfData:
         self.data = data
         self.elf = elftools.elf.elffile.ELFFile(io.BytesIO(self.data))
         self._flat = None
+        self._symbols = None
+        self._disasm = None
 
     @classmethod
     def from_file(cls, path):
@@ -120,27 +261,33 @@ class ElfData:
             f.write(self.disassemble())
 
     def disassemble(self):
+        if self._disasm is not None:
+            return self._disasm
+
         with tempfile.TemporaryDirectory(prefix='risky-compiler.') as d:
             elfpath = os.path.join(d, 'program.elf')
             self.dump(elfpath)
 
-            p = subprocess.run([
+            p = _run([
                 'riscv-none-elf-objdump',
                 '-D',
                 elfpath,
-            ], check=True, capture_output=True, text=True)
+            ], stdout=subprocess.PIPE)
 
-            return p.stdout
+            self._disasm = p.stdout
+            return self._disasm
 
     def symbols(self):
-        symbols = {}
-        for sec in self.elf.iter_sections():
-            if not isinstance(sec, elftools.elf.sections.SymbolTableSection):
-                continue
-            for sym in sec.iter_symbols():
-                symbols[sym.name] = sym.entry.st_value
+        if self._symbols is not None:
+            return self._symbols
 
-        return symbols
+        self._symbols = {
+            sym.name: sym.entry.st_value
+            for sec in self.elf.iter_sections()
+            if isinstance(sec, elftools.elf.sections.SymbolTableSection)
+            for sym in sec.iter_symbols()
+        }
+        return self._symbols
 
     def dump_flat(self, fname):
         with open(fname, 'wb') as f:
@@ -148,27 +295,49 @@ class ElfData:
 
     @property
     def flat(self):
-        if self._flat:
+        if self._flat is not None:
             return self._flat
 
-        with tempfile.TemporaryDirectory(prefix='risky-compiler.') as d:
-            elfpath = os.path.join(d, 'program.elf')
-            binpath = os.path.join(d, 'program.bin')
+        # this is what objcopy -O binary does, roughly: lay out every
+        # allocated section with contents at its load address, starting
+        # from the lowest. going by sections rather than segments keeps
+        # out the elf and program headers, which ld may put in the first
+        # loaded segment
+        sections = [
+            sec for sec in self.elf.iter_sections()
+            if sec.header.sh_flags & elftools.elf.constants.SH_FLAGS.SHF_ALLOC
+            and sec.header.sh_type != 'SHT_NOBITS' and sec.header.sh_size > 0
+        ]
 
-            self.dump(elfpath)
+        if not sections:
+            self._flat = b''
+            return self._flat
 
-            subprocess.run([
-                'riscv-none-elf-objcopy',
-                '-O', 'binary',
-                elfpath,
-                binpath,
-            ], check=True)
+        # a section's load address is its address, moved along with the
+        # segment that holds it
+        def lma(sec):
+            for seg in self.elf.iter_segments():
+                if seg.header.p_type == 'PT_LOAD' and seg.section_in_segment(sec):
+                    return sec.header.sh_addr - seg.header.p_vaddr + seg.header.p_paddr
+            return sec.header.sh_addr
 
-            with open(binpath, 'rb') as f:
-                self._flat = f.read()
+        placed = [(lma(sec), sec) for sec in sections]
+        base = min(addr for addr, _ in placed)
+        end = max(addr + sec.header.sh_size for addr, sec in placed)
 
-            return self._flat
+        flat = bytearray(end - base)
+        for addr, sec in placed:
+            start = addr - base
+            flat[start:start + sec.header.sh_size] = sec.data()
+
+        self._flat = bytes(flat)
+        return self._flat
 
     @property
     def flat_words(self):
-        return list(x[0] for x in struct.iter_unpack('<I', self.flat))
+        # array does the unpacking in C, unlike struct.iter_unpack
+        words = array.array('I', self.flat)
+        assert words.itemsize == 4
+        if sys.byteorder != 'little':
+            words.byteswap()
+        return words.tolist()
@@ -1,8 +1,10 @@
 import collections
+import functools
 
 import amaranth as am
 import amaranth.lib.data
 import amaranth.lib.enum
+import amaranth.lib.memory
 
 from risky.instruction import Instruction, Reg, Op, Funct3Branch, Funct3Alu, Funct7Alu, Funct3Mem, Funct3Csr
 import risky.memory
@@ -13,6 +15,11 @@ class Extension:
     def prepare(self, cpu):
         pass
 
+    # control table entries to add, as (op, funct3, fields) where
+    # funct3 may be None to match all of them
+    def decode_rules(self):
+        return []
+
     def elaborate_pre(self, platform, cpu, m):
         pass
 
@@ -30,37 +37,74 @@ class State(am.lib.enum.Enum):
     FETCH_INSTR = 0
     EXECUTE = 1
 
-class Cpu(am.lib.wiring.Component):
-    bus: am.lib.wiring.Out(risky.memory.MemoryBus())
+# a bare synchronous memory port, for simulators that want to provide
+# memory themselves without going through a wishbone handshake
+class SimpleMemoryBus(am.lib.wiring.Signature):
+    def __init__(self, addr_width=30):
+        super().__init__({
+            # cpu -> memory
+            'addr': am.lib.wiring.Out(addr_width),
+            'req': am.lib.wiring.Out(1),
+            'we': am.lib.wiring.Out(1),
+            'sel': am.lib.wiring.Out(4),
+            'data_w': am.lib.wiring.Out(32),
+
+            # memory -> cpu
+            'data_r': am.lib.wiring.In(32),
+            'ready': am.lib.wiring.In(1),
+        })
 
+class Cpu(am.lib.wiring.Component):
     xlen = 32
     march_base = 'rv32i'
 
-    def __init__(self, extensions=[]):
-        super().__init__()
+    def __init__(self, extensions=[], simple_bus=False):
+        # with simple_bus, the wishbone bus is internal only, and the
+        # outside world sees a SimpleMemoryBus called mem instead
+        self.simple_bus = simple_bus
+        if simple_bus:
+            super().__init__({
+                'mem': am.lib.wiring.Out(SimpleMemoryBus()),
+            })
+            self.bus = risky.memory.memory_bus().create()
+        else:
+            super().__init__({
+                'bus': am.lib.wiring.Out(risky.memory.memory_bus()),
+            })
 
         # core state
         self.state = am.Signal(State)
         self.pc = am.Signal(self.xlen)
         self.instr = am.Signal(Instruction)
+        self.decoded = am.Signal(DecodedInstr)
+
+        # fields of instr worked out in FETCH_INSTR
+        self.fields = am.Signal(DecodedFields)
 
         # re-usable pc adder
         self.pc_plus_inc = am.Signal(self.xlen)
         self.pc_inc = am.Signal(self.xlen)
 
+        # pc of the next instruction, usually pc_plus_inc
+        self.pc_next = am.Signal(self.xlen)
+
+        # set high by instructions that use the bus in EXECUTE, which
+        # holds off the prefetch of the next instruction
+        self.mem_access = am.Signal(1)
+
+        # high when the next instruction arrives off the bus
+        self.instr_ack = am.Signal(1)
+
         # set high by recognized instructions
         self.is_valid_instruction = am.Signal(1)
         # used by unit tests
         self.assert_unknown_instructions = False
 
-        # register file
-        regs = []
-        for i, r in enumerate(Reg):
-            assert r.value == i
-            regs.append(am.Signal(self.xlen, name='x{}_{}'.format(i, r.name.lower())))
-        self.regs = am.Array(regs)
+        # register file, as a memory so it can live in block ram
+        self.regfile = am.lib.memory.Memory(shape=self.xlen, depth=len(Reg), init=[0] * len(Reg))
+        self.regs = self.regfile.data
 
-        # hold values of rs1 / rs2 from instr
+        # values of rs1 / rs2 from instr, read out of the register file
         self.rs1 = am.Signal(self.xlen)
         self.rs2 = am.Signal(self.xlen)
 
@@ -71,13 +115,26 @@ class Cpu(am.lib.wiring.Component):
         # our alu
         self.alu = Alu(self.xlen)
 
+        # lines up memory data for loads and stores
+        self.aligner = Aligner(self.xlen)
+
         self.extensions = collections.OrderedDict()
         for extension in extensions:
             self.extensions[extension.__class__.__name__] = extension
         for extension in self.extensions.values():
             extension.prepare(self)
 
-    @property
+        # control table to decode the rest of instr with, including
+        # whatever the extensions add to it
+        rules = []
+        for extension in self.extensions.values():
+            for op, funct3, fields in extension.decode_rules():
+                rules.append((op, funct3, tuple(sorted(fields.items()))))
+        table = control_table(tuple(rules))
+        self.control = am.lib.memory.Memory(shape=ControlWord, depth=len(table), init=table)
+
+    # extensions are fixed after __init__, so these never change
+    @functools.cached_property
     def march_parts(self):
         letters = []
         words = []
@@ -93,9 +150,9 @@ class Cpu(am.lib.wiring.Component):
         letters.sort()
         words.sort()
 
-        return [self.march_base] + letters + words
+        return tuple([self.march_base] + letters + words)
 
-    @property
+    @functools.cached_property
     def march(self):
         base, *rest = self.march_parts
         for r in rest:
@@ -110,62 +167,123 @@ class Cpu(am.lib.wiring.Component):
         m = am.Module()
 
         m.submodules.alu = self.alu
+        m.submodules.aligner = self.aligner
+        m.submodules.regfile = self.regfile
+        m.submodules.control = self.control
+
+        # the control word is looked up when the instruction arrives
+        control_port = self.control.read_port(domain='sync')
+        m.d.comb += [
+            self.decoded.op.eq(self.fields.op),
+            self.decoded.imm.eq(self.fields.imm),
+            self.decoded.rd_nonzero.eq(self.fields.rd_nonzero),
+            self.decoded.rs1_nonzero.eq(self.fields.rs1_nonzero),
+            self.decoded.ctrl.eq(control_port.data),
+            control_port.en.eq(0),
+        ]
+
+        # rs1 / rs2 are read when the instruction arrives, and hold after.
+        # the reads are transparent, so a write to rd in the same cycle
+        # is forwarded straight through
+        rd_port = self.regfile.write_port(domain='sync')
+        rs1_port = self.regfile.read_port(domain='sync', transparent_for=[rd_port])
+        rs2_port = self.regfile.read_port(domain='sync', transparent_for=[rd_port])
+        m.d.comb += [
+            self.rs1.eq(rs1_port.data),
+            self.rs2.eq(rs2_port.data),
+            rs1_port.en.eq(0),
+            rs2_port.en.eq(0),
+        ]
+
+        if self.simple_bus:
+            m.d.comb += [
+                self.mem.addr.eq(self.bus.adr),
+                self.mem.req.eq(self.bus.cyc & self.bus.stb),
+                self.mem.we.eq(self.bus.we),
+                self.mem.sel.eq(self.bus.sel),
+                self.mem.data_w.eq(self.bus.dat_w),
+                self.bus.dat_r.eq(self.mem.data_r),
+                self.bus.ack.eq(self.mem.ready),
+            ]
 
         # set up reasonable combinatoric defaults to prevent
-        # too much value changing
+        # too much value changing. every state uses the bus, and
+        # FETCH_INSTR fetches from pc with these as they are
         m.d.comb += [
             self.bus.adr.eq(self.pc[2:]),
+            self.bus.cyc.eq(1),
+            self.bus.stb.eq(1),
             self.bus.sel.eq(0b1111),
 
             self.pc_inc.eq(4),
 
             self.rd.eq(self.alu.out),
 
-            self.alu.in1.eq(self.rs1),
-            self.alu.in2.eq(self.rs2),
-            self.alu.op.eq(AluOp.ADD),
-            self.alu.shift_amount.eq(self.instr.rs2),
+            self.alu.in1.eq(am.Mux(self.decoded.ctrl.alu_in1_pc, self.pc, self.rs1)),
+            self.alu.in2.eq(am.Mux(self.decoded.ctrl.alu_in2_imm, self.decoded.imm, self.rs2)),
+            self.alu.op.eq(self.decoded.ctrl.alu_op),
+            self.alu.shift_amount.eq(self.alu.in2),
         ]
 
         # re-usable pc adder
         m.d.comb += self.pc_plus_inc.eq(self.pc + self.pc_inc)
+        m.d.comb += self.pc_next.eq(self.pc_plus_inc)
 
-        # write to rd if enabled
-        with m.If(self.rd_write_en):
-            # only write to non-zero registers
-            with m.If(self.instr.rd != Reg.ZERO):
-                m.d.sync += self.regs[self.instr.rd].eq(self.rd)
+        # write to rd if enabled, but only to non-zero registers, and
+        # never for a bad instruction, whatever its table entry says
+        m.d.comb += [
+            rd_port.addr.eq(self.instr.rd),
+            rd_port.data.eq(self.rd),
+            rd_port.en.eq(self.rd_write_en & self.decoded.rd_nonzero & self.is_valid_instruction),
+        ]
+
+        # validity mostly comes from the control table, but it
+        # only sees one bit of funct7, so check the rest here.
+        # it doesn't see the low two bits of op either, but the
+        # one-hot op compares all of it, so a word that aliases
+        # a table entry (like all zeros) has no op bit set.
+        # this is only a default: it comes before the extensions, so
+        # their calls to valid_instruction can still override it
+        funct7_ok = (self.instr.funct7.raw & ~0b0100000) == 0
+        op_known = self.decoded.op.as_value().any()
+        m.d.comb += self.is_valid_instruction.eq(self.decoded.ctrl.valid & op_known & (funct7_ok | ~self.decoded.ctrl.check_funct7))
 
         for v in self.extensions.values():
             v.elaborate_pre(platform, self, m)
 
+        # the next instruction, as it comes off the bus. it's latched in
+        # FETCH_INSTR, or straight out of EXECUTE when the prefetch there
+        # is acked in the same cycle, so that straight-line code on a
+        # zero-wait memory never visits FETCH_INSTR at all
+        instr = Instruction(self.bus.dat_r)
+        fields = am.Signal(DecodedFields)
+        self.decode(platform, m, instr, fields)
+
         # core state machine
         with m.Switch(self.state):
             with m.Case(State.FETCH_INSTR):
-                m.d.comb += [
-                    self.bus.adr.eq(self.pc[2:]),
-                    self.bus.cyc.eq(1),
-                    self.bus.stb.eq(1),
-                    self.bus.sel.eq(0b1111),
-                ]
-
-                with m.If(self.bus.ack):
-                    instr = Instruction(self.bus.dat_r)
-                    m.d.sync += [
-                        self.instr.eq(instr),
-                        self.rs1.eq(self.regs[instr.rs1]),
-                        self.rs2.eq(self.regs[instr.rs2]),
-                        self.state.eq(State.EXECUTE),
-                    ]
+                m.d.comb += self.instr_ack.eq(self.bus.ack)
 
             with m.Case(State.EXECUTE):
                 # default to advancing to next instruction,
                 # unless something else overwrites this
                 m.d.sync += [
-                    self.pc.eq(self.pc_plus_inc),
+                    self.pc.eq(self.pc_next),
                     self.state.eq(State.FETCH_INSTR),
                 ]
 
+                # start fetching the next instruction now. if the bus
+                # acks it this cycle, we go right on to executing it,
+                # otherwise it is acked in FETCH_INSTR.
+                # instructions that use the bus override this, and set
+                # mem_access so their ack isn't taken for an instruction
+                m.d.comb += [
+                    self.bus.adr.eq(self.pc_next[2:]),
+                    self.instr_ack.eq(self.bus.ack & ~self.mem_access),
+                ]
+
+                m.d.comb += self.rd_write_en.eq(self.decoded.ctrl.rd_write_en)
+
                 self.execute(platform, m)
                 for v in self.extensions.values():
                     v.execute(platform, self, m)
@@ -178,352 +296,130 @@ class Cpu(am.lib.wiring.Component):
                     else:
                         m.d.sync += am.Print(info)
 
+        # latch the next instruction, from either state. this comes after
+        # EXECUTE so it can override the return to FETCH_INSTR there
+        with m.If(self.instr_ack):
+            m.d.sync += [
+                self.instr.eq(instr),
+                self.fields.eq(fields),
+                self.state.eq(State.EXECUTE),
+            ]
+
+            # rd is written in the same cycle when this happens in
+            # EXECUTE, which the transparent read ports forward
+            m.d.comb += [
+                rs1_port.addr.eq(instr.rs1),
+                rs2_port.addr.eq(instr.rs2),
+                rs1_port.en.eq(1),
+                rs2_port.en.eq(1),
+
+                control_port.addr.eq(control_index(instr)),
+                control_port.en.eq(1),
+            ]
+
         for v in self.extensions.values():
             v.elaborate_post(platform, self, m)
 
         return m
 
-    def execute(self, platform, m):
-        with m.Switch(self.instr.op):
-            with m.Case(Op.LUI):
-                self.valid_instruction(platform, m)
-                m.d.comb += [
-                    self.rd_write_en.eq(1),
-                    self.rd.eq(self.instr.imm_u),
-                ]
-
-            with m.Case(Op.AUIPC):
-                self.valid_instruction(platform, m)
-                m.d.comb += [
-                    self.rd_write_en.eq(1),
+    def decode(self, platform, m, instr, fields):
+        # pick out the immediate for this instruction's format, and the
+        # register checks EXECUTE would otherwise repeat every cycle.
+        # everything else EXECUTE needs comes out of the control table
+        imm = fields.imm
+        m.d.comb += [
+            imm.eq(instr.imm_i),
+            fields.rd_nonzero.eq(instr.rd != Reg.ZERO),
+            fields.rs1_nonzero.eq(instr.rs1 != Reg.ZERO),
+        ]
 
-                    self.alu.in1.eq(self.pc),
-                    self.alu.in2.eq(self.instr.imm_u),
-                    self.alu.op.eq(AluOp.ADD),
-                    self.rd.eq(self.alu.out),
-                ]
+        for op in Op:
+            m.d.comb += getattr(fields.op, op.name.lower()).eq(instr.op == op)
 
+        with m.Switch(instr.op):
+            with m.Case(Op.LUI, Op.AUIPC):
+                m.d.comb += imm.eq(instr.imm_u)
             with m.Case(Op.JAL):
-                self.valid_instruction(platform, m)
-                m.d.comb += [
-                    self.rd_write_en.eq(1),
-                    self.rd.eq(self.pc + 4),
-
-                    self.pc_inc.eq(self.instr.imm_j)
-                ]
-
-            with m.Case(Op.JALR):
-                with m.If(self.instr.funct3.as_value() == 000):
-                    self.valid_instruction(platform, m)
-
-                    m.d.comb += [
-                        self.rd_write_en.eq(1),
-                        self.rd.eq(self.pc_plus_inc),
-
-                        self.alu.in1.eq(self.rs1),
-                        self.alu.in2.eq(self.instr.imm_i),
-                        self.alu.op.eq(AluOp.ADD),
-                    ]
-
-                    # careful: LSB needs to be set to 0
-                    m.d.sync += self.pc.eq(am.Cat(0, self.alu.out[1:]))
-
+                m.d.comb += imm.eq(instr.imm_j)
             with m.Case(Op.BRANCH):
-                # common to all branches is comparing rs1 and rs2
-                m.d.comb += [
-                    self.alu.in1.eq(self.rs1),
-                    self.alu.in2.eq(self.rs2),
-                ]
-
-                with m.Switch(self.instr.funct3.branch):
-                    with m.Case(Funct3Branch.EQ):
-                        self.valid_instruction(platform, m)
-                        m.d.comb += self.alu.op.eq(AluOp.EQ),
-                        with m.If(self.alu.out[0]):
-                            m.d.comb += self.pc_inc.eq(self.instr.imm_b)
-
-                    with m.Case(Funct3Branch.NE):
-                        self.valid_instruction(platform, m)
-                        m.d.comb += self.alu.op.eq(AluOp.EQ),
-                        with m.If(~self.alu.out[0]):
-                            m.d.comb += self.pc_inc.eq(self.instr.imm_b)
-
-                    with m.Case(Funct3Branch.LT):
-                        self.valid_instruction(platform, m)
-                        m.d.comb += self.alu.op.eq(AluOp.LT),
-                        with m.If(self.alu.out[0]):
-                            m.d.comb += self.pc_inc.eq(self.instr.imm_b)
-
-                    with m.Case(Funct3Branch.GE):
-                        self.valid_instruction(platform, m)
-                        m.d.comb += self.alu.op.eq(AluOp.LT),
-                        with m.If(~self.alu.out[0]):
-                            m.d.comb += self.pc_inc.eq(self.instr.imm_b)
-
-                    with m.Case(Funct3Branch.LTU):
-                        self.valid_instruction(platform, m)
-                        m.d.comb += self.alu.op.eq(AluOp.LTU),
-                        with m.If(self.alu.out[0]):
-                            m.d.comb += self.pc_inc.eq(self.instr.imm_b)
-
-                    with m.Case(Funct3Branch.GEU):
-                        self.valid_instruction(platform, m)
-                        m.d.comb += self.alu.op.eq(AluOp.LTU),
-                        with m.If(~self.alu.out[0]):
-                            m.d.comb += self.pc_inc.eq(self.instr.imm_b)
-
-            with m.Case(Op.LOAD):
-                # all of these load from rs1 + imm_i
-                dest = self.rs1 + self.instr.imm_i
-                m.d.comb += [
-                    self.bus.adr.eq(dest[2:]),
-                    self.bus.cyc.eq(1),
-                    self.bus.stb.eq(1),
-                ]
-
-                with m.If(self.bus.ack):
-                    # do the load and continue
-                    data = self.bus.dat_r
-
-                    # shift data
-                    shift = am.Mux(
-                        self.instr.funct3.mem == Funct3Mem.WORD,
-                        0,
-                        dest[:2],
-                    )
-                    shift &= am.Mux(
-                        self.instr.funct3.mem.matches(Funct3Mem.HALF, Funct3Mem.HALF_U),
-                        0b10,
-                        0b11,
-                    )
-                    data = data >> (shift << 3)
-
-                    # mask data by sel
-                    mask = am.Cat(
-                        *(sel.replicate(8) for sel in self.bus.sel),
-                    ) >> (shift << 3)
-                    data &= mask
-
-                    # sign extend data
-                    sign = am.Mux(
-                        self.instr.funct3.mem.matches(Funct3Mem.BYTE),
-                        data[7],
-                        am.Mux(
-                            self.instr.funct3.mem.matches(Funct3Mem.HALF),
-                            data[15],
-                            0,
-                        ),
-                    )
-                    data |= (~mask) & sign.replicate(self.xlen)
+                m.d.comb += imm.eq(instr.imm_b)
+            with m.Case(Op.STORE):
+                m.d.comb += imm.eq(instr.imm_s)
 
+    def execute(self, platform, m):
+        dec = self.decoded
+
+        # ops are one-hot, so these are all tested side by side
+        with m.If(dec.op.load | dec.op.store):
+            # loads read from rs1 + imm_i, and stores write rs2 to
+            # rs1 + imm_s. either way, the address is out of the alu
+            dest = self.alu.out
+            store = dec.op.store
+            m.d.comb += [
+                self.mem_access.eq(1),
+
+                self.bus.adr.eq(dest[2:]),
+                self.bus.we.eq(store),
+                self.bus.sel.eq(self.aligner.sel),
+                self.bus.dat_w.eq(self.aligner.data_out),
+
+                self.aligner.data_in.eq(am.Mux(store, self.rs2, self.bus.dat_r)),
+                self.aligner.addr.eq(dest[:2]),
+                self.aligner.width.eq(self.instr.funct3.raw[:2]),
+                self.aligner.signed.eq(~self.instr.funct3.raw[2]),
+                self.aligner.store.eq(store),
+            ]
+
+            # both continue to the next instruction as soon as the
+            # bus acks, which may be in this same cycle
+            with m.If(self.bus.ack):
+                with m.If(~store):
+                    # set rd to our loaded data
                     m.d.comb += [
-                        # set rd to our loaded data
-                        self.rd.eq(data),
+                        self.rd.eq(self.aligner.data_out),
                         self.rd_write_en.eq(1),
                     ]
 
-                with m.Else():
-                    # stall until ack
-                    m.d.comb += self.pc_inc.eq(0)
-                    m.d.sync += self.state.eq(State.EXECUTE)
-
-                with m.Switch(self.instr.funct3.mem):
-                    with m.Case(Funct3Mem.BYTE):
-                        self.valid_instruction(platform, m)
-                        sel = 1 << dest[:2]
-                        m.d.comb += self.bus.sel.eq(sel)
-
-                    with m.Case(Funct3Mem.HALF):
-                        self.valid_instruction(platform, m)
-                        sel = 0b11 << (dest[:2] & 0b10)
-                        m.d.comb += self.bus.sel.eq(sel)
-
-                    with m.Case(Funct3Mem.WORD):
-                        self.valid_instruction(platform, m)
-                        sel = 0b1111
-                        m.d.comb += self.bus.sel.eq(sel)
-
-                    with m.Case(Funct3Mem.BYTE_U):
-                        self.valid_instruction(platform, m)
-                        sel = 1 << dest[:2]
-                        m.d.comb += self.bus.sel.eq(sel)
-
-                    with m.Case(Funct3Mem.HALF_U):
-                        self.valid_instruction(platform, m)
-                        sel = 0b11 << (dest[:2] & 0b10)
-                        m.d.comb += self.bus.sel.eq(sel)
-
-            with m.Case(Op.STORE):
-                # all of these write rs2 to rs1 + imm_s
-                src = self.rs2
-                dest = self.rs1 + self.instr.imm_s
+            with m.Else():
+                # stall until ack
+                m.d.comb += self.pc_inc.eq(0)
+                m.d.sync += self.state.eq(State.EXECUTE)
+
+        with m.If(dec.op.branch):
+            # the alu compares rs1 and rs2, odd funct3 inverts it
+            with m.If(dec.ctrl.valid & (self.alu.out[0] ^ self.instr.funct3.raw[0])):
+                m.d.comb += self.pc_inc.eq(dec.imm)
+
+        with m.If(dec.op.jal):
+            # the alu is free, so it computes the target, leaving
+            # the pc adder to compute the return address
+            m.d.comb += [
+                self.rd.eq(self.pc_plus_inc),
+                self.pc_next.eq(self.alu.out),
+            ]
+
+        with m.If(dec.op.jalr):
+            with m.If(dec.ctrl.valid):
+                # careful: LSB needs to be set to 0
                 m.d.comb += [
-                    self.bus.adr.eq(dest[2:]),
-                    self.bus.cyc.eq(1),
-                    self.bus.stb.eq(1),
-                    self.bus.we.eq(1),
+                    self.rd.eq(self.pc_plus_inc),
+                    self.pc_next.eq(am.Cat(0, self.alu.out[1:])),
                 ]
 
-                # wait here until ack
-                with m.If(~self.bus.ack):
-                    m.d.comb += self.pc_inc.eq(0)
-                    m.d.sync += self.state.eq(State.EXECUTE)
-
-                with m.Switch(self.instr.funct3.mem):
-                    with m.Case(Funct3Mem.BYTE):
-                        self.valid_instruction(platform, m)
-                        byte = am.Cat(*(src[:8] for _ in range(4)))
-                        m.d.comb += [
-                            self.bus.dat_w.eq(byte),
-                            self.bus.sel.eq(1 << dest[:2]),
-                        ]
-
-                    with m.Case(Funct3Mem.HALF):
-                        self.valid_instruction(platform, m)
-                        half = am.Cat(*(src[:16] for _ in range(2)))
-                        m.d.comb += [
-                            self.bus.dat_w.eq(half),
-                            self.bus.sel.eq(0b11 << (dest[:2] & 0b10)),
-                        ]
-
-                    with m.Case(Funct3Mem.WORD):
-                        self.valid_instruction(platform, m)
-                        m.d.comb += [
-                            self.bus.dat_w.eq(src),
-                            self.bus.sel.eq(0b1111),
-                        ]
-
-            with m.Case(Op.OP_IMM):
-                # by default, excepting shifts, these operate on
-                # rs1 and imm_i
-                # all of them store into rd
-                m.d.comb += [
-                    self.alu.in1.eq(self.rs1),
-                    self.alu.in2.eq(self.instr.imm_i),
-                    self.rd.eq(self.alu.out),
-                    self.rd_write_en.eq(1),
-                ]
+        with m.If(dec.op.lui):
+            m.d.comb += self.rd.eq(dec.imm)
 
-                with m.Switch(self.instr.funct3.alu):
-                    with m.Case(Funct3Alu.ADD_SUB):
-                        self.valid_instruction(platform, m)
-                        m.d.comb += self.alu.op.eq(AluOp.ADD)
-                    with m.Case(Funct3Alu.LT):
-                        self.valid_instruction(platform, m)
-                        m.d.comb += self.alu.op.eq(AluOp.LT)
-                    with m.Case(Funct3Alu.LTU):
-                        self.valid_instruction(platform, m)
-                        m.d.comb += self.alu.op.eq(AluOp.LTU)
-                    with m.Case(Funct3Alu.XOR):
-                        self.valid_instruction(platform, m)
-                        m.d.comb += self.alu.op.eq(AluOp.XOR)
-                    with m.Case(Funct3Alu.OR):
-                        self.valid_instruction(platform, m)
-                        m.d.comb += self.alu.op.eq(AluOp.OR)
-                    with m.Case(Funct3Alu.AND):
-                        self.valid_instruction(platform, m)
-                        m.d.comb += self.alu.op.eq(AluOp.AND)
-
-                    # shifts are a bit special
-
-                    with m.Case(Funct3Alu.SHIFT_L):
-                        with m.If(self.instr.funct7.alu == Funct7Alu.NORMAL):
-                            self.valid_instruction(platform, m)
-                            m.d.comb += [
-                                self.alu.op.eq(AluOp.SHIFT_LL),
-                                self.alu.shift_amount.eq(self.instr.rs2),
-                            ]
-
-                    with m.Case(Funct3Alu.SHIFT_R):
-                        with m.If(self.instr.funct7.alu == Funct7Alu.NORMAL):
-                            self.valid_instruction(platform, m)
-                            m.d.comb += [
-                                self.alu.op.eq(AluOp.SHIFT_RL),
-                                self.alu.shift_amount.eq(self.instr.rs2),
-                            ]
-                        with m.Elif(self.instr.funct7.alu == Funct7Alu.ALT):
-                            self.valid_instruction(platform, m)
-                            m.d.comb += [
-                                self.alu.op.eq(AluOp.SHIFT_RA),
-                                self.alu.shift_amount.eq(self.instr.rs2),
-                            ]
-
-            with m.Case(Op.OP):
-                # by default these operate on rs1 and rs2 and store into rd
-                m.d.comb += [
-                    self.alu.in1.eq(self.rs1),
-                    self.alu.in2.eq(self.rs2),
-                    self.rd.eq(self.alu.out),
-                    self.rd_write_en.eq(1),
-                ]
+        # FIXME FENCE, FENCE.TSO, PAUSE
 
-                with m.Switch(self.instr.funct3.alu):
-                    with m.Case(Funct3Alu.ADD_SUB):
-                        with m.If(self.instr.funct7.alu == Funct7Alu.NORMAL):
-                            self.valid_instruction(platform, m)
-                            m.d.comb += self.alu.op.eq(AluOp.ADD)
-                        with m.Elif(self.instr.funct7.alu == Funct7Alu.ALT):
-                            self.valid_instruction(platform, m)
-                            m.d.comb += self.alu.op.eq(AluOp.SUB)
-
-                    with m.Case(Funct3Alu.SHIFT_L):
-                        with m.If(self.instr.funct7.alu == Funct7Alu.NORMAL):
-                            self.valid_instruction(platform, m)
-                            m.d.comb += [
-                                self.alu.op.eq(AluOp.SHIFT_LL),
-                                self.alu.shift_amount.eq(self.rs2),
-                            ]
-
-                    with m.Case(Funct3Alu.LT):
-                        with m.If(self.instr.funct7.alu == Funct7Alu.NORMAL):
-                            self.valid_instruction(platform, m)
-                            m.d.comb += self.alu.op.eq(AluOp.LT)
-
-                    with m.Case(Funct3Alu.LTU):
-                        with m.If(self.instr.funct7.alu == Funct7Alu.NORMAL):
-                            self.valid_instruction(platform, m)
-                            m.d.comb += self.alu.op.eq(AluOp.LTU)
-
-                    with m.Case(Funct3Alu.XOR):
-                        with m.If(self.instr.funct7.alu == Funct7Alu.NORMAL):
-                            self.valid_instruction(platform, m)
-                            m.d.comb += self.alu.op.eq(AluOp.XOR)
-
-                    with m.Case(Funct3Alu.SHIFT_R):
-                        with m.If(self.instr.funct7.alu == Funct7Alu.NORMAL):
-                            self.valid_instruction(platform, m)
-                            m.d.comb += [
-                                self.alu.op.eq(AluOp.SHIFT_RL),
-                                self.alu.shift_amount.eq(self.rs2),
-                            ]
-                        with m.Elif(self.instr.funct7.alu == Funct7Alu.ALT):
-                            self.valid_instruction(platform, m)
-                            m.d.comb += [
-                                self.alu.op.eq(AluOp.SHIFT_RA),
-                                self.alu.shift_amount.eq(self.rs2),
-                            ]
-
-                    with m.Case(Funct3Alu.OR):
-                        with m.If(self.instr.funct7.alu == Funct7Alu.NORMAL):
-                            self.valid_instruction(platform, m)
-                            m.d.comb += self.alu.op.eq(AluOp.OR)
-
-                    with m.Case(Funct3Alu.AND):
-                        with m.If(self.instr.funct7.alu == Funct7Alu.NORMAL):
-                            self.valid_instruction(platform, m)
-                            m.d.comb += self.alu.op.eq(AluOp.AND)
-
-            # FIXME FENCE, FENCE.TSO, PAUSE
-
-            with m.Case(Op.SYSTEM):
-                with m.Switch(self.instr):
-                    with m.Case(0b000000000000_00000_000_00000_1110011):
-                        # FIXME ecall
-                        pass
-                    with m.Case(0b000000000001_00000_000_00000_1110011):
-                        # stall on ebreak
-                        self.valid_instruction(platform, m)
-                        m.d.comb += self.pc_inc.eq(0)
+        with m.If(dec.op.system):
+            with m.Switch(self.instr):
+                with m.Case(0b000000000000_00000_000_00000_1110011):
+                    # FIXME ecall
+                    pass
+                with m.Case(0b000000000001_00000_000_00000_1110011):
+                    # stall on ebreak
+                    self.valid_instruction(platform, m)
+                    m.d.comb += self.pc_inc.eq(0)
 
     def valid_instruction(self, platform, m):
         m.d.comb += self.is_valid_instruction.eq(1)
@@ -547,10 +443,11 @@ class Cpu(am.lib.wiring.Component):
             self.pc,
             self.state,
             {'instr': self.instr},
+            {'decoded': self.decoded},
             self.is_valid_instruction,
         ]
 
-        t['registers'] = [r for r in self.regs]
+        t['registers'] = [self.regs]
 
         t['alu'] = [
             self.alu.in1,
@@ -582,6 +479,122 @@ class AluOp(am.lib.enum.Enum):
     OR = 9
     AND = 10
 
+# how EXECUTE should set up the datapath for an instruction
+class ControlWord(am.lib.data.Struct):
+    alu_op: AluOp
+    alu_in1_pc: 1
+    alu_in2_imm: 1
+    rd_write_en: 1
+
+    # valid, as long as funct7 is otherwise zero when check_funct7 is set
+    valid: 1
+    check_funct7: 1
+
+# one bit per opcode, so EXECUTE tests a wire instead of comparing op
+OpOneHot = am.lib.data.StructLayout({op.name.lower(): 1 for op in Op})
+
+# fields pulled out of an instruction as it arrives
+class DecodedFields(am.lib.data.Struct):
+    op: OpOneHot
+    imm: 32
+    rd_nonzero: 1
+    rs1_nonzero: 1
+
+# the parts of an instruction EXECUTE needs, worked out ahead of time
+class DecodedInstr(am.lib.data.Struct):
+    op: OpOneHot
+    imm: 32
+    rd_nonzero: 1
+    rs1_nonzero: 1
+    ctrl: ControlWord
+
+def control_index(instr):
+    # the low two bits of op are always set for 32-bit instructions,
+    # and only bit 5 of funct7 matters to the datapath
+    return am.Cat(instr.op.as_value()[2:], instr.funct3.raw, instr.funct7.raw[5])
+
+@functools.lru_cache(maxsize=None)
+def control_table(rules=()):
+    alu_ops = {
+        Funct3Alu.ADD_SUB: AluOp.ADD,
+        Funct3Alu.SHIFT_L: AluOp.SHIFT_LL,
+        Funct3Alu.LT: AluOp.LT,
+        Funct3Alu.LTU: AluOp.LTU,
+        Funct3Alu.XOR: AluOp.XOR,
+        Funct3Alu.SHIFT_R: AluOp.SHIFT_RL,
+        Funct3Alu.OR: AluOp.OR,
+        Funct3Alu.AND: AluOp.AND,
+    }
+
+    # the inverted conditions are handled in execute()
+    branch_ops = {
+        Funct3Branch.EQ: AluOp.EQ,
+        Funct3Branch.NE: AluOp.EQ,
+        Funct3Branch.LT: AluOp.LT,
+        Funct3Branch.GE: AluOp.LT,
+        Funct3Branch.LTU: AluOp.LTU,
+        Funct3Branch.GEU: AluOp.LTU,
+    }
+
+    load_widths = [Funct3Mem.BYTE, Funct3Mem.HALF, Funct3Mem.WORD, Funct3Mem.BYTE_U, Funct3Mem.HALF_U]
+    store_widths = [Funct3Mem.BYTE, Funct3Mem.HALF, Funct3Mem.WORD]
+
+    table = []
+    for index in range(1 << 9):
+        op = ((index & 0b11111) << 2) | 0b11
+        funct3 = (index >> 5) & 0b111
+        alt = (index >> 8) & 1
+
+        ctrl = dict(alu_op=AluOp.ADD, alu_in1_pc=0, alu_in2_imm=0, rd_write_en=0, valid=0, check_funct7=0)
+        if op == Op.LUI.value:
+            ctrl.update(rd_write_en=1, valid=1)
+        elif op == Op.AUIPC.value:
+            ctrl.update(alu_in1_pc=1, alu_in2_imm=1, rd_write_en=1, valid=1)
+        elif op == Op.JAL.value:
+            ctrl.update(alu_in1_pc=1, alu_in2_imm=1, rd_write_en=1, valid=1)
+        elif op == Op.JALR.value:
+            if funct3 == 0:
+                ctrl.update(alu_in2_imm=1, rd_write_en=1, valid=1)
+        elif op == Op.LOAD.value:
+            ctrl.update(alu_in2_imm=1, valid=int(funct3 in [w.value for w in load_widths]))
+        elif op == Op.STORE.value:
+            ctrl.update(alu_in2_imm=1, valid=int(funct3 in [w.value for w in store_widths]))
+        elif op == Op.BRANCH.value:
+            try:
+                ctrl.update(alu_op=branch_ops[Funct3Branch(funct3)], valid=1)
+            except ValueError:
+                pass
+        elif op in (Op.OP_IMM.value, Op.OP.value):
+            ctrl.update(alu_op=alu_ops[Funct3Alu(funct3)], rd_write_en=1)
+            if op == Op.OP_IMM.value:
+                ctrl.update(alu_in2_imm=1)
+
+            # only OP has SUB, but both have SHIFT_RA
+            if alt and funct3 == Funct3Alu.SHIFT_R.value:
+                ctrl.update(alu_op=AluOp.SHIFT_RA)
+            elif alt and funct3 == Funct3Alu.ADD_SUB.value and op == Op.OP.value:
+                ctrl.update(alu_op=AluOp.SUB)
+
+            # OP_IMM only uses funct7 for shifts, the rest is immediate
+            if op == Op.OP.value or funct3 in (Funct3Alu.SHIFT_L.value, Funct3Alu.SHIFT_R.value):
+                ctrl.update(check_funct7=1)
+                if not alt:
+                    ctrl.update(valid=1)
+                elif funct3 == Funct3Alu.SHIFT_R.value:
+                    ctrl.update(valid=1)
+                elif funct3 == Funct3Alu.ADD_SUB.value and op == Op.OP.value:
+                    ctrl.update(valid=1)
+            else:
+                ctrl.update(valid=1)
+
+        for rule_op, rule_funct3, fields in rules:
+            if rule_op.value == op and rule_funct3 in (None, funct3):
+                ctrl.update(fields)
+
+        table.append(ctrl)
+
+    return table
+
 class Alu(am.lib.wiring.Component):
     def __init__(self, xlen):
         super().__init__({
@@ -594,8 +607,7 @@ class Alu(am.lib.wiring.Component):
         })
 
         self.xlen = xlen
-        self.minus = am.Signal(xlen + 1)
-        self.plus = am.Signal(xlen)
+        self.sum = am.Signal(xlen + 1)
         self.eq = am.Signal(1)
         self.ltu = am.Signal(1)
         self.lt = am.Signal(1)
@@ -603,26 +615,32 @@ class Alu(am.lib.wiring.Component):
     def elaborate(self, platform):
         m = am.Module()
 
-        # set up our intermediates
+        # one shared adder does ADD, and everything else that needs it
+        # as in1 + ~in2 + 1. the top bit is then the carry out, which is
+        # clear exactly when in1 < in2 unsigned
+        sub = self.op != AluOp.ADD
         m.d.comb += [
-            self.minus.eq(self.in1.as_unsigned() - self.in2.as_unsigned()),
-            self.plus.eq(self.in1 + self.in2),
-            self.eq.eq(self.minus[:-1] == 0),
-            self.ltu.eq(self.minus[-1]),
-            self.lt.eq(am.Mux(self.in1[-1] ^ self.in2[-1], self.in1[-1], self.minus[-1])),
+            self.sum.eq(self.in1 + (self.in2 ^ sub.replicate(self.xlen)) + sub),
+            self.eq.eq(self.sum[:-1] == 0),
+            self.ltu.eq(~self.sum[-1]),
+            self.lt.eq(am.Mux(self.in1[-1] ^ self.in2[-1], self.in1[-1], ~self.sum[-1])),
         ]
 
-        # shared shifter for ll / rl / ra
-        shift_in = am.Mux(self.op == AluOp.SHIFT_LL, self.in1[::-1], self.in1)
-        rightshift = am.Cat(shift_in, (self.op == AluOp.SHIFT_RA) & shift_in[-1]).as_signed() >> self.shift_amount
-        leftshift = rightshift[:-1][::-1]
+        # one shifter each way, one stage per bit of shift_amount, each
+        # shifting by 1 << k. right shifts fill with the sign bit for
+        # ra, and left shifts always fill with zero
+        fill = (self.op == AluOp.SHIFT_RA) & self.in1[-1]
+        rightshift = self.in1
+        leftshift = self.in1
+        for k, bit in enumerate(self.shift_amount):
+            n = 1 << k
+            rightshift = am.Mux(bit, am.Cat(rightshift[n:], fill.replicate(n)), rightshift)
+            leftshift = am.Mux(bit, am.Cat(am.C(0, n), leftshift[:-n]), leftshift)
 
         # ok, now push the right one to out
         with m.Switch(self.op):
-            with m.Case(AluOp.ADD):
-                m.d.comb += self.out.eq(self.plus)
-            with m.Case(AluOp.SUB):
-                m.d.comb += self.out.eq(self.minus)
+            with m.Case(AluOp.ADD, AluOp.SUB):
+                m.d.comb += self.out.eq(self.sum)
             with m.Case(AluOp.SHIFT_LL):
                 m.d.comb += self.out.eq(leftshift)
             with m.Case(AluOp.SHIFT_RL):
@@ -644,6 +662,63 @@ class Alu(am.lib.wiring.Component):
 
         return m
 
+class Aligner(am.lib.wiring.Component):
+    def __init__(self, xlen):
+        super().__init__({
+            'data_in': am.lib.wiring.In(xlen),
+            # low bits of the address
+            'addr': am.lib.wiring.In(2),
+            # 0 for bytes, 1 for halves, 2 for words, as in funct3
+            'width': am.lib.wiring.In(2),
+            'signed': am.lib.wiring.In(1),
+            # rotate into place on the bus, rather than out of it
+            'store': am.lib.wiring.In(1),
+
+            'data_out': am.lib.wiring.Out(xlen),
+            'sel': am.lib.wiring.Out(4),
+        })
+
+        self.xlen = xlen
+
+    def elaborate(self, platform):
+        m = am.Module()
+
+        # byte lanes covered on the bus
+        with m.Switch(self.width):
+            with m.Case(0):
+                m.d.comb += self.sel.eq(am.C(1, 4) << self.addr)
+            with m.Case(1):
+                m.d.comb += self.sel.eq(am.Mux(self.addr[1], 0b1100, 0b0011))
+            with m.Default():
+                m.d.comb += self.sel.eq(0b1111)
+
+        with m.If(self.store):
+            # stores copy the data into every lane, sel picks the right one
+            with m.Switch(self.width):
+                with m.Case(0):
+                    m.d.comb += self.data_out.eq(self.data_in[:8].replicate(self.xlen // 8))
+                with m.Case(1):
+                    m.d.comb += self.data_out.eq(self.data_in[:16].replicate(self.xlen // 16))
+                with m.Default():
+                    m.d.comb += self.data_out.eq(self.data_in)
+
+        with m.Else():
+            # loads pick their lane out directly, one case per width and
+            # address, each with its own sign bit
+            with m.Switch(am.Cat(self.addr, self.width)):
+                for i in range(4):
+                    lane = self.data_in.word_select(i, 8)
+                    with m.Case('00{:02b}'.format(i)):
+                        m.d.comb += self.data_out.eq(am.Cat(lane, (self.signed & lane[-1]).replicate(self.xlen - 8)))
+                for i in range(2):
+                    lane = self.data_in.word_select(i, 16)
+                    with m.Case('01{}-'.format(i)):
+                        m.d.comb += self.data_out.eq(am.Cat(lane, (self.signed & lane[-1]).replicate(self.xlen - 16)))
+                with m.Default():
+                    m.d.comb += self.data_out.eq(self.data_in)
+
+        return m
+
 class Zicsr(Extension):
     march = 'zicsr'
 
@@ -662,7 +737,7 @@ class Zicsr(Extension):
     def elaborate_pre(self, platform, cpu, m):
         # some defaults
         m.d.comb += [
-            self.csr_addr.eq(cpu.instr.imm_i.as_unsigned()),
+            self.csr_addr.eq(cpu.decoded.imm[:12]),
         ]
 
         # rs1 interpreted as an immediate value, 0-extended to xlen
@@ -679,6 +754,11 @@ class Zicsr(Extension):
             )
         )
 
+    def decode_rules(self):
+        # every csr instruction writes rd. validity depends on the csr
+        # address, so that's left to the csr implementations
+        return [(Op.SYSTEM, funct3.value, {'rd_write_en': 1}) for funct3 in Funct3Csr]
+
     def valid_csr(self, platform, cpu, m, read=True, write=True):
         if read and write:
             with m.If(self.csr_read_en | self.csr_write_en):
@@ -694,86 +774,26 @@ class Zicsr(Extension):
         
 
     def execute(self, platform, cpu, m):
-        # we require the csr implementations to call self.valid_csr
-        with m.If(cpu.instr.op == Op.SYSTEM):
-            with m.Switch(cpu.instr.funct3.csr):
-                with m.Case(Funct3Csr.RW):
-                    m.d.comb += [
-                        # no read side effects if rd is zero
-                        self.csr_read_en.eq(cpu.instr.rd != Reg.ZERO),
-                        cpu.rd_write_en.eq(1),
-                        cpu.rd.eq(self.csr_read_data),
-
-                        self.csr_write_en.eq(1),
-                        self.modify.eq(0),
-                        self.setbits.eq(1),
-                        self.new.eq(cpu.rs1),
-                    ]
-
-                with m.Case(Funct3Csr.RS):
-                    m.d.comb += [
-                        self.csr_read_en.eq(1),
-                        cpu.rd_write_en.eq(1),
-                        cpu.rd.eq(self.csr_read_data),
-
-                        # no write side effects if rs1 is zero
-                        self.csr_write_en.eq(cpu.instr.rs1 != Reg.ZERO),
-                        self.modify.eq(1),
-                        self.setbits.eq(1),
-                        self.new.eq(cpu.rs1),
-                    ]
+        # funct3 is already a packed table: the low two bits pick RW,
+        # RS or RC, and the high bit picks uimm over rs1. zero in the
+        # low bits isn't a csr instruction at all
+        funct3 = cpu.instr.funct3.raw
+        modify = funct3[1]
 
-                with m.Case(Funct3Csr.RC):
-                    m.d.comb += [
-                        self.csr_read_en.eq(1),
-                        cpu.rd_write_en.eq(1),
-                        cpu.rd.eq(self.csr_read_data),
-
-                        # no write side effects if rs1 is zero
-                        self.csr_write_en.eq(cpu.instr.rs1 != Reg.ZERO),
-                        self.modify.eq(1),
-                        self.setbits.eq(0),
-                        self.new.eq(cpu.rs1),
-                    ]
-
-                with m.Case(Funct3Csr.RWI):
-                    m.d.comb += [
-                        # no read side effects if rd is zero
-                        self.csr_read_en.eq(cpu.instr.rd != Reg.ZERO),
-                        cpu.rd_write_en.eq(1),
-                        cpu.rd.eq(self.csr_read_data),
-
-                        self.csr_write_en.eq(1),
-                        self.modify.eq(0),
-                        self.setbits.eq(1),
-                        self.new.eq(self.uimm),
-                    ]
-
-                with m.Case(Funct3Csr.RSI):
-                    m.d.comb += [
-                        self.csr_read_en.eq(1),
-                        cpu.rd_write_en.eq(1),
-                        cpu.rd.eq(self.csr_read_data),
-
-                        # no write side effects if uimm is zero
-                        self.csr_write_en.eq(self.uimm != 0),
-                        self.modify.eq(1),
-                        self.setbits.eq(1),
-                        self.new.eq(self.uimm),
-                    ]
-
-                with m.Case(Funct3Csr.RCI):
-                    m.d.comb += [
-                        self.csr_read_en.eq(1),
-                        cpu.rd_write_en.eq(1),
-                        cpu.rd.eq(self.csr_read_data),
-
-                        # no write side effects if uimm is zero
-                        self.csr_write_en.eq(self.uimm != 0),
-                        self.modify.eq(1),
-                        self.setbits.eq(0),
-                        self.new.eq(self.uimm),
-                    ]
+        # we require the csr implementations to call self.valid_csr
+        with m.If(cpu.decoded.op.system & funct3[:2].any()):
+            m.d.comb += [
+                # RW has no read side effects if rd is zero
+                self.csr_read_en.eq(modify | cpu.decoded.rd_nonzero),
+                cpu.rd.eq(self.csr_read_data),
+
+                # RS and RC have no write side effects if rs1 is zero,
+                # which for the immediate forms means uimm is zero
+                self.csr_write_en.eq(~modify | cpu.decoded.rs1_nonzero),
+                self.modify.eq(modify),
+                self.setbits.eq(~(funct3[1] & funct3[0])),
+                self.new.eq(am.Mux(funct3[2], self.uimm, cpu.rs1)),
+            ]
 
     @property
     def debug_traces(self):
@@ -789,54 +809,56 @@ class Zicntr(Extension):
     # some gcc don't support this, and it also doesn't really matter
     #march = 'zicntr'
 
+    # the spec asks for 64 bit counters, but narrower ones save flops
+    # when nothing needs them to run that long
+    def __init__(self, width=64):
+        self.width = width
+
     def prepare(self, cpu):
         try:
             self.csr = cpu.extensions['Zicsr']
         except KeyError:
             raise RuntimeError('Zicntr requires Zicsr')
 
-        self.cycle = am.Signal(64)
+        self.cycle = am.Signal(self.width)
         self.time = self.cycle # a valid implementation of time
-        self.instret = am.Signal(64)
+        self.instret = am.Signal(self.width)
+
+    def count(self, m, counter, enable):
+        # split the counter in halves, so the high half only needs to
+        # increment when the low half carries out
+        half = len(counter) // 2
+        low = am.Signal(half + 1)
+        m.d.comb += low.eq(counter[:half] + enable)
+        m.d.sync += counter[:half].eq(low[:half])
+        with m.If(low[-1]):
+            m.d.sync += counter[half:].eq(counter[half:] + 1)
 
     def elaborate_pre(self, platform, cpu, m):
         # cycle is easy
-        m.d.sync += self.cycle.eq(self.cycle + 1)
+        self.count(m, self.cycle, 1)
 
         # we'll cheat and increment instret on every good instruction fetch
         # technically, some instructions never retire. so, FIXME
-        with m.If(cpu.state.matches(State.FETCH_INSTR) & cpu.bus.ack):
-            m.d.sync += self.instret.eq(self.instret + 1)
-
-        # these registers are read-only
-        with m.Switch(self.csr.csr_addr):
-            with m.Case(0xc00):
-                # cycle
-                self.csr.valid_csr(platform, cpu, m, write=False)
-                m.d.comb += self.csr.csr_read_data.eq(self.cycle)
-            with m.Case(0xc01):
-                # time
-                self.csr.valid_csr(platform, cpu, m, write=False)
-                m.d.comb += self.csr.csr_read_data.eq(self.time)
-            with m.Case(0xc02):
-                # instret
-                self.csr.valid_csr(platform, cpu, m, write=False)
-                m.d.comb += self.csr.csr_read_data.eq(self.instret)
-
-            # only do high side if needed
-            if cpu.xlen < 64:
-                with m.Case(0xc80):
-                    # cycleh
-                    self.csr.valid_csr(platform, cpu, m, write=False)
-                    m.d.comb += self.csr.csr_read_data.eq(self.cycle[32:])
-                with m.Case(0xc81):
-                    # timeh
-                    self.csr.valid_csr(platform, cpu, m, write=False)
-                    m.d.comb += self.csr.csr_read_data.eq(self.time[32:])
-                with m.Case(0xc82):
-                    # instret
-                    self.csr.valid_csr(platform, cpu, m, write=False)
-                    m.d.comb += self.csr.csr_read_data.eq(self.instret[32:])
+        self.count(m, self.instret, cpu.instr_ack)
+
+        # these registers are read-only, and sit at 0xc00 + n, with
+        # their high halves at 0xc80 + n. time is cycle, so one lookup
+        # on the low address bits covers them all
+        addr = self.csr.csr_addr
+        index = addr[:2]
+        counter = am.Array([self.cycle, self.time, self.instret])[index]
+
+        # only do high side if needed
+        high = '-' if cpu.xlen < 64 else '0'
+        with m.If(addr.matches('1100{}00000--'.format(high)) & (index != 0b11)):
+            self.csr.valid_csr(platform, cpu, m, write=False)
+            if cpu.xlen < 64 and self.width > 32:
+                m.d.comb += self.csr.csr_read_data.eq(am.Mux(addr[7], counter[32:], counter))
+            else:
+                # any high halves are empty, and read as zero
+                with m.If(~addr[7]):
+                    m.d.comb += self.csr.csr_read_data.eq(counter)
 
     @property
     def debug_traces(self):
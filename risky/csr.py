@@ -1,5 +1,4 @@
 import contextlib
-import math
 
 import amaranth as am
 
@@ -18,7 +17,7 @@ class Peripheral(am.lib.wiring.Component):
         if depth is None:
             depth = 1 << addr_width
         if addr_width is None:
-            addr_width = int(math.ceil(math.log2(depth)))
+            addr_width = (depth - 1).bit_length()
 
         self.depth = depth
         self.addr_width = addr_width
@@ -28,12 +28,13 @@ class Demo(am.Elaboratable):
 
         debugreg = soc.output.output[0]
         
+        leds = []
         for i in debugreg:
             try:
-                led = platform.request('led', i.start)
+                leds.append(platform.request('led', i.start).o)
             except am.build.ResourceError:
                 break
-            m.d.comb += led.o.eq(i)
+        m.d.comb += am.Cat(*leds).eq(debugreg[:len(leds)])
 
         uart = platform.request('uart')
         m.d.comb += [
@@ -1,3 +1,5 @@
+import functools
+
 import amaranth as am
 import amaranth.lib.enum
 import amaranth.lib.data
@@ -112,18 +114,18 @@ class Instruction(am.lib.data.Struct):
     rs2: Reg = 0
     funct7: Funct7 = {'raw': 0}
 
-    @property
+    @functools.cached_property
     def imm_i(self):
         imm_11_0 = am.Cat(self.rs2, self.funct7)
         return imm_11_0.as_signed()
 
-    @property
+    @functools.cached_property
     def imm_s(self):
         imm_11_5 = self.funct7.raw
         imm_4_0 = self.rd.as_value()
         return am.Cat(imm_4_0, imm_11_5).as_signed()
 
-    @property
+    @functools.cached_property
     def imm_b(self):
         imm_12__10_5 = self.funct7.raw
         imm_4_1__11 = self.rd.as_value()
@@ -134,14 +136,19 @@ class Instruction(am.lib.data.Struct):
         imm_11 = imm_4_1__11[0]
         return am.Cat(0, imm_4_1, imm_10_5, imm_11, imm_12).as_signed()
 
-    @property
+    # imm_u and imm_j both start from the same top 20 bits
+    @functools.cached_property
+    def _imm_upper(self):
+        return am.Cat(self.funct3, self.rs1, self.rs2, self.funct7)
+
+    @functools.cached_property
     def imm_u(self):
-        imm_31_12 = am.Cat(self.funct3, self.rs1, self.rs2, self.funct7)
+        imm_31_12 = self._imm_upper
         return (imm_31_12 << 12).as_signed()
 
-    @property
+    @functools.cached_property
     def imm_j(self):
-        imm_20__10_1__11__19_12 = am.Cat(self.funct3, self.rs1, self.rs2, self.funct7)
+        imm_20__10_1__11__19_12 = self._imm_upper
 
         imm_19_12 = imm_20__10_1__11__19_12[:8]
         imm_11 = imm_20__10_1__11__19_12[8]
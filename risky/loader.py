@@ -3,11 +3,10 @@ import sys
 
 import serial
 
-BANNER_RE = re.compile(b'risky-b([0-9]+)(?:\r\n|\r|\n)')
-ERR_RE = re.compile(b'e:\s+(.+)(?:\r\n|\r|\n)')
-STATUS_RE = re.compile(b'([a-z])\s+([0-9a-fA-F]+)(?:\r\n|\r|\n)')
-INFO_RE = re.compile(b'([a-z]+)\s+([0-9a-fA-F]+)(?:\r\n|\r|\n)')
-READ_RE = re.compile(b'([0-9a-fA-F]+):((?:\s+[0-9a-fA-F]+)+)(?:\r\n|\r|\n)')
+# these match whole lines, with the line ending already stripped
+BANNER_RE = re.compile(b'risky-b([0-9]+)$')
+ERR_RE = re.compile(b'e:\s+(.+)')
+STATUS_RE = re.compile(b'([a-z])\s+([0-9a-fA-F]+)')
 
 class Bootloader:
     def __init__(self, port, baud=115200):
@@ -15,6 +14,7 @@ class Bootloader:
 
         self.version = None
         self.info = None
+        self.write_chunk_size = None
 
     @property
     def banner(self):
@@ -30,7 +30,7 @@ class Bootloader:
 
     def wait_for_reset(self):
         while True:
-            line = self.ser.readline()
+            line = self.ser.readline().rstrip(b'\r\n')
             m = BANNER_RE.search(line)
             if m:
                 self.version = int(m.group(1))
@@ -42,14 +42,21 @@ class Bootloader:
                 if not line.strip().endswith(self.info['banner']):
                     raise RuntimeError('bootloader info responded with unexpected banner')
 
+                # as many bytes as fit in one write line
+                self.write_chunk_size = (self.buffer_size - len(b'p 00000000\r\n')) // len(b' 00')
+
                 break
 
     def command(self, char, *args, response=True):
+        line = char + ' ' + ' '.join('{:x}'.format(a) for a in args)
+        return self.command_line(char, line.encode('utf-8'), response=response)
+
+    # like command, but with the line already formatted
+    def command_line(self, char, line, response=True):
         if not self.version:
             raise RuntimeError('bootloader not connected')
 
-        line = char + ' ' + ' '.join('{:x}'.format(a) for a in args)
-        self.ser.write(line.encode('utf-8') + b'\r\n')
+        self.ser.write(line + b'\r\n')
 
         if not response:
             return
@@ -59,16 +66,19 @@ class Bootloader:
         response = []
 
         while True:
-            line = self.ser.readline()
-
-            m = ERR_RE.match(line)
-            if m:
-                raise RuntimeError('bootloader reported error: {}'.format(m.group(1).decode('utf-8')))
+            line = self.ser.readline().rstrip(b'\r\n')
+
+            # most lines are neither, and a glance at the first bytes
+            # rules them out without running either regex
+            if line[:2] == b'e:':
+                m = ERR_RE.fullmatch(line)
+                if m:
+                    raise RuntimeError('bootloader reported error: {}'.format(m.group(1).decode('utf-8')))
+            elif line[:1] == char:
+                m = STATUS_RE.fullmatch(line)
+                if m:
+                    return (int(m.group(2), 16), response)
 
-            m = STATUS_RE.match(line)
-            if m and m.group(1) == char:
-                return (int(m.group(2), 16), response)
-                
             response.append(line)
 
     def read_info(self):
@@ -82,7 +92,7 @@ class Bootloader:
         names = b'bk'
 
         for line in lines[1:]:
-            m = STATUS_RE.match(line)
+            m = STATUS_RE.fullmatch(line)
             if not m or not m.group(1) in names:
                 raise RuntimeError('unexpected line in bootloader info: {}'.format(line))
 
@@ -98,30 +108,50 @@ class Bootloader:
 
         self.version = None
         self.info = None
+        self.write_chunk_size = None
 
-    def read_memory(self, start, end):
+    # reads len(out) bytes at start into out, with a single command
+    def _read_into(self, start, out):
+        end = start + len(out)
         amount, lines = self.command('m', start, end)
         if amount != end - start:
             raise RuntimeError('bootloader response is incorrect number of bytes')
 
-        data = b''
         current = start
         for line in lines:
-            m = READ_RE.match(line)
-            if not m:
+            # lines are an address, a colon, and then bytes as two hex
+            # digits each, separated by whitespace. simple enough to not
+            # need a regex
+            addr, colon, payload = line.partition(b':')
+            try:
+                addr = int(addr, 16)
+                new = bytes.fromhex(payload.decode('ascii'))
+            except ValueError:
+                new = None
+            if not colon or not new:
                 raise RuntimeError('unexpected line from bootloader read: {}'.format(line))
 
-            if int(m.group(1), 16) != current:
-                raise RuntimeError('bad address from bootloader read: {}'.format(int(m.group(1), 16)))
-
-            new = [int(d, 16) for d in m.group(2).split()]
-            data += bytes(new)
+            if addr != current:
+                raise RuntimeError('bad address from bootloader read: {}'.format(addr))
+            if current + len(new) > end:
+                raise RuntimeError('bootloader returned incorrect number of bytes')
+            out[current - start:current - start + len(new)] = new
             current += len(new)
 
-        if not len(data) == amount:
+        if current != end:
             raise RuntimeError('bootloader returned incorrect number of bytes')
 
-        return data
+    def read_memory(self, start, end):
+        data = bytearray(end - start)
+        self._read_into(start, data)
+        return bytes(data)
+
+    # like read_memory_stream, but fills out (anything writable, like a
+    # bytearray) in place rather than allocating every chunk
+    def read_memory_into(self, start, out, chunk_size=256):
+        out = memoryview(out)
+        for i in range(0, len(out), chunk_size):
+            self._read_into(start + i, out[i:i + chunk_size])
 
     def read_memory_stream(self, start, end, chunk_size=256):
         cur = start
@@ -141,11 +171,16 @@ class Bootloader:
 
     def write_memory_stream(self, start, data):
         i = 0
-        chunk_size = (self.buffer_size - len(b'p 00000000\r\n')) // len(b' 00')
+        chunk_size = self.write_chunk_size
 
+        # slice chunks out of a view, so they aren't copied
+        data = memoryview(data)
         while i < len(data):
             chunk = data[i:i + chunk_size]
-            amount, lines = self.command('p', start + i, *chunk)
+
+            # bytes.hex formats the whole chunk at once
+            line = 'p {:x} '.format(start + i).encode('utf-8') + chunk.hex(' ').encode('utf-8')
+            amount, lines = self.command_line('p', line)
             i += len(chunk)
 
             if amount != len(chunk):
@@ -163,6 +198,7 @@ class Bootloader:
     def attach(self):
         # FIXME forward stdin too
         while True:
-            b = self.ser.read()
+            # block for one byte, then take whatever else has arrived
+            b = self.ser.read(self.ser.in_waiting or 1)
             sys.stdout.buffer.write(b)
-            sys.stdout.flush()
+            sys.stdout.buffer.flush()
@@ -1,7 +1,7 @@
 import collections
 import contextlib
 import dataclasses
-import math
+import functools
 import struct
 
 import amaranth as am
@@ -24,16 +24,20 @@ def unpack_data(width, data):
 
     width_bytes = width // 8
 
-    fmt = '<' + fmt
-    while len(data) % width_bytes != 0:
-        data += b'\0'
-
-    return list(x[0] for x in struct.iter_unpack(fmt, data))
+    # pad out to a whole word, then unpack every word in one call
+    data = bytes(data) + bytes(-len(data) % width_bytes)
+    return list(struct.unpack('<{}{}'.format(len(data) // width_bytes, fmt), data))
 
 class MemoryBus(amaranth_soc.wishbone.Signature):
     def __init__(self, addr_width=30):
         super().__init__(addr_width=addr_width, data_width=32, granularity=8)
 
+# signatures with the same parameters are interchangeable, and every
+# component makes one, so share them
+@functools.lru_cache(maxsize=None)
+def memory_bus(addr_width=30):
+    return MemoryBus(addr_width=addr_width)
+
 class MemoryComponent(am.lib.wiring.Component):
     memory_x_access = None
 
@@ -43,14 +47,14 @@ class MemoryComponent(am.lib.wiring.Component):
         if depth is None:
             depth = 1 << addr_width
         if addr_width is None:
-            addr_width = int(math.ceil(math.log2(depth)))
+            addr_width = (depth - 1).bit_length()
 
         self.depth = depth
         self.addr_width = addr_width
 
         # add bus to it, but let it override bus if it does
         signature_with_bus = {
-            'bus': am.lib.wiring.In(MemoryBus(addr_width=self.addr_width)),
+            'bus': am.lib.wiring.In(memory_bus(addr_width=self.addr_width)),
         }
 
         signature_with_bus.update(signature)
@@ -58,10 +62,15 @@ class MemoryComponent(am.lib.wiring.Component):
 
         # create a default memory map
         # careful -- memory map is addressed in self.bus.granularity
-        extra = int(math.ceil(math.log2(self.bus.data_width // self.bus.granularity)))
+        extra = (self.bus.data_width // self.bus.granularity - 1).bit_length()
         self.bus.memory_map = amaranth_soc.memory.MemoryMap(addr_width=self.addr_width + extra, data_width=self.bus.granularity)
         self.bus.memory_map.add_resource(self, name='data', size=self.depth * (1 << extra))
 
+    # (do_read, do_write) for the current bus cycle
+    def bus_strobes(self):
+        transfer = self.bus.cyc & self.bus.stb
+        return (transfer & ~self.bus.we, transfer & self.bus.we)
+
     def __getitem__(self, addr):
         raise RuntimeError('memory component {} does not support simulation access'.format(self.__class__.__name__))
 
@@ -97,17 +106,21 @@ class CSRMap(MemoryComponent):
         return m
 
 class MemoryMap(MemoryComponent):
-    def __init__(self, addr_width=30, alignment=0):
+    def __init__(self, addr_width=30, alignment=0, pipelined=False):
         super().__init__(addr_width=addr_width)
+        self.pipelined = pipelined
         self.components = collections.OrderedDict()
         self.decoder = amaranth_soc.wishbone.Decoder(addr_width=self.bus.addr_width, data_width=self.bus.data_width, granularity=self.bus.granularity, alignment=alignment)
         self.bus.memory_map = self.decoder.bus.memory_map
+        self._resource_tree = None
 
     def align_to(self, alignment):
         self.decoder.align_to(alignment)
+        self._resource_tree = None
 
     def add(self, name, component, addr=None):
         self.decoder.add(component.bus, name=name, addr=addr)
+        self._resource_tree = None
         self.components[name] = component
         return component
 
@@ -142,13 +155,49 @@ class MemoryMap(MemoryComponent):
         m = am.Module()
 
         m.submodules._decoder = self.decoder
-        am.lib.wiring.connect(m, am.lib.wiring.flipped(self.bus), self.decoder.bus)
+        if self.pipelined:
+            self.elaborate_pipeline(m)
+        else:
+            am.lib.wiring.connect(m, am.lib.wiring.flipped(self.bus), self.decoder.bus)
 
         for name, c in self.components.items():
             m.submodules[name] = c
 
         return m
 
+    # registers the request on the way in and the response on the way
+    # out, so the decoder and its muxes are off the master's paths. this
+    # costs two cycles of latency on every access
+    def elaborate_pipeline(self, m):
+        inner = self.decoder.bus
+        pending = am.Signal(1)
+
+        m.d.comb += [
+            inner.cyc.eq(pending),
+            inner.stb.eq(pending),
+        ]
+
+        # ack is only ever high for one cycle
+        m.d.sync += self.bus.ack.eq(0)
+
+        with m.If(pending):
+            with m.If(inner.ack):
+                m.d.sync += [
+                    pending.eq(0),
+                    self.bus.ack.eq(1),
+                    self.bus.dat_r.eq(inner.dat_r),
+                ]
+        with m.Elif(self.bus.cyc & self.bus.stb & ~self.bus.ack):
+            # the master still holds its request while it sees ack, so
+            # only take a new one on the cycles after
+            m.d.sync += [
+                pending.eq(1),
+                inner.adr.eq(self.bus.adr),
+                inner.dat_w.eq(self.bus.dat_w),
+                inner.sel.eq(self.bus.sel),
+                inner.we.eq(self.bus.we),
+            ]
+
     @dataclasses.dataclass
     class ResourceNode:
         path: list[str]
@@ -188,6 +237,32 @@ class MemoryMap(MemoryComponent):
             else:
                 return None
 
+        # (c_type, name, count) for each member of a C struct laid out
+        # like this group, with uint8_t arrays filling the gaps. None
+        # unless every child is a naturally aligned register with a C type.
+        # names that aren't C identifiers, like gpio's numbered registers,
+        # get an R in front, so '0' becomes R0
+        @property
+        def c_struct_members(self):
+            if self.resource or not self.children:
+                return None
+
+            members = []
+            offset = 0
+            for n in self.children.values():
+                if n.resource is None or n.c_type is None or n.offset % n.size:
+                    return None
+                if n.offset > offset:
+                    members.append(('uint8_t', '_reserved{}'.format(len(members)), n.offset - offset))
+                member = n.name.upper()
+                if not member.isidentifier():
+                    member = 'R' + member
+                if not (member.isascii() and member.isidentifier()):
+                    return None
+                members.append((n.c_type, member, None))
+                offset = n.offset + n.size
+            return members
+
         @property
         def memory_x_access(self):
             if self.resource:
@@ -200,6 +275,11 @@ class MemoryMap(MemoryComponent):
             return None
 
     def get_resource_tree(self):
+        # the memory map is frozen once all_resources() is called, so
+        # this can be built once and shared by every generator
+        if self._resource_tree is not None:
+            return self._resource_tree
+
         tree = {}
         for r in self.bus.memory_map.all_resources():
             path = [str(p) for part in r.path for p in part]
@@ -208,32 +288,39 @@ class MemoryMap(MemoryComponent):
                 _, leaf = leaf.setdefault(part, (path[:i + 1], {}))
             leaf[path[-1]] = (path, r)
 
-        def reify_tree(path, t):
-            if isinstance(t, dict):
-                children = []
-                start = None
-                end = None
-                for k, (subpath, subtree) in t.items():
-                    r = reify_tree(subpath, subtree)
-                    if start is None or r.start < start:
-                        start = r.start
-                    if end is None or r.end > end:
-                        end = r.end
-
-                    children.append((k, r))
-
-                # update offset
-                for _, n in children:
-                    n.offset = n.start - start
-
-                children.sort(key=lambda t: t[1].start)
-                children = collections.OrderedDict(children)
-
-                return self.ResourceNode(path=path, start=start, end=end, offset=start, children=children)
-            else:
-                return self.ResourceNode(path=path, start=t.start, end=t.end, offset=t.start, resource=t.resource)
-
-        return reify_tree([], tree)
+        # build the nodes top-down, leaving group extents for later
+        root = self.ResourceNode(path=[], start=None, end=None, offset=None)
+        groups = []
+        stack = [(root, tree)]
+        while stack:
+            node, t = stack.pop()
+            groups.append(node)
+            for k, (subpath, subtree) in t.items():
+                if isinstance(subtree, dict):
+                    child = self.ResourceNode(path=subpath, start=None, end=None, offset=None)
+                    stack.append((child, subtree))
+                else:
+                    child = self.ResourceNode(path=subpath, start=subtree.start, end=subtree.end, offset=subtree.start, resource=subtree.resource)
+                node.children[k] = child
+
+        # groups come after their parents, so going backwards sees
+        # every child's extent before its parent needs it
+        for node in reversed(groups):
+            children = sorted(node.children.items(), key=lambda kv: kv[1].start)
+            start = min(n.start for _, n in children)
+            end = max(n.end for _, n in children)
+
+            node.children = collections.OrderedDict()
+            for k, n in children:
+                n.offset = n.start - start
+                node.children[k] = n
+
+            node.start = start
+            node.end = end
+            node.offset = start
+
+        self._resource_tree = root
+        return root
 
     def __getitem__(self, addr):
         r = self.bus.memory_map.decode_address(addr)
@@ -247,8 +334,6 @@ class MemoryMap(MemoryComponent):
         internal_addr = addr - info.start
         return r[internal_addr]
 
-# unfortunately quartus does not infer memory with byte enables correctly
-# so we must fake one with an async read + sync write
 class Ram(MemoryComponent):
     memory_x_access = 'rwx'
 
@@ -257,6 +342,9 @@ class Ram(MemoryComponent):
         WRITE = 1
 
     def __init__(self, init=[], depth=None):
+        # init may also be raw bytes, packed into words here
+        if isinstance(init, (bytes, bytearray, memoryview)):
+            init = unpack_data(memory_bus().data_width, init)
         if depth is None:
             depth = len(init)
 
@@ -271,23 +359,57 @@ class Ram(MemoryComponent):
         m.submodules.memory = self.memory
 
         read = self.memory.read_port(domain='sync')
+        do_read, do_write = self.bus_strobes()
+
+        m.d.comb += [
+            read.addr.eq(self.bus.adr),
+            self.bus.dat_r.eq(read.data),
+        ]
+
+        if getattr(platform, 'toolchain', None) == 'Quartus':
+            self.elaborate_read_modify_write(m, read, do_read, do_write)
+            return m
+
+        # a write port with byte lanes, so sel drives the byte enables
+        write = self.memory.write_port(domain='sync', granularity=self.bus.granularity)
+
+        m.d.comb += [
+            read.en.eq(do_read),
+
+            write.addr.eq(self.bus.adr),
+            write.data.eq(self.bus.dat_w),
+            write.en.eq(self.bus.sel & (do_write & ~self.bus.ack).replicate(len(self.bus.sel))),
+        ]
+
+        m.d.sync += self.bus.ack.eq((do_read | do_write) & ~self.bus.ack)
+
+        return m
+
+    # unfortunately quartus does not infer memory with byte enables correctly
+    # so we must fake one with a read, then a full-width write
+    def elaborate_read_modify_write(self, m, read, do_read, do_write):
         write = self.memory.write_port(domain='sync')
 
         state = am.Signal(self.RamState)
-        do_write = self.bus.cyc & self.bus.we & self.bus.stb
-        do_read = self.bus.cyc & ~self.bus.we & self.bus.stb
 
-        mask = am.Cat(*(am.Mux(bit, 0xff, 0) for bit in self.bus.sel))
-        internal_write_data = (read.data & ~mask) | (self.bus.dat_w & mask)
+        # each byte lane comes from the bus if selected, else from memory
+        granularity = self.bus.granularity
+        internal_write_data = am.Cat(*(
+            am.Mux(bit, self.bus.dat_w.word_select(i, granularity), read.data.word_select(i, granularity))
+            for i, bit in enumerate(self.bus.sel)
+        ))
+
+        # whole words have nothing to merge, so they skip the read and
+        # write straight away, like the byte lane path does
+        full_word = self.bus.sel.all()
+        write_now = do_write & full_word & ~self.bus.ack
 
         m.d.comb += [
-            read.addr.eq(self.bus.adr),
-            self.bus.dat_r.eq(read.data),
-            read.en.eq(do_read | ((state == self.RamState.READ) & do_write)),
+            read.en.eq(do_read | ((state == self.RamState.READ) & do_write & ~full_word)),
 
             write.addr.eq(self.bus.adr),
             write.data.eq(internal_write_data),
-            write.en.eq((state == self.RamState.WRITE) & do_write),
+            write.en.eq(((state == self.RamState.WRITE) & do_write) | write_now),
         ]
 
         # default to 0
@@ -298,7 +420,9 @@ class Ram(MemoryComponent):
 
         with m.Switch(state):
             with m.Case(self.RamState.READ):
-                with m.If(do_write):
+                with m.If(write_now):
+                    m.d.sync += self.bus.ack.eq(1)
+                with m.Elif(do_write & ~full_word):
                     m.d.sync += [
                         state.eq(self.RamState.WRITE),
                         self.bus.ack.eq(1),
@@ -306,8 +430,6 @@ class Ram(MemoryComponent):
             with m.Case(self.RamState.WRITE):
                 m.d.sync += state.eq(self.RamState.READ)
 
-        return m
-
     def __getitem__(self, addr):
         return self.memory.data[addr >> (self.bus.memory_map.addr_width - self.bus.addr_width)]
 
@@ -319,6 +441,9 @@ class Rom(MemoryComponent):
     memory_x_access = 'rx'
 
     def __init__(self, init=[], depth=None):
+        # init may also be raw bytes, packed into words here
+        if isinstance(init, (bytes, bytearray, memoryview)):
+            init = unpack_data(memory_bus().data_width, init)
         if depth is None:
             depth = len(init)
 
@@ -334,8 +459,7 @@ class Rom(MemoryComponent):
 
         read = self.memory.read_port(domain='sync')
 
-        do_write = self.bus.cyc & self.bus.we & self.bus.stb
-        do_read = self.bus.cyc & ~self.bus.we & self.bus.stb
+        do_read, do_write = self.bus_strobes()
 
         m.d.comb += [
             read.addr.eq(self.bus.adr),
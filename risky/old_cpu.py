@@ -109,7 +109,7 @@ class State(am.lib.enum.Enum):
     STORE = 6
 
 class Cpu(am.lib.wiring.Component):
-    bus: am.lib.wiring.Out(risky.memory.MemoryBus())
+    bus: am.lib.wiring.Out(risky.memory.memory_bus())
 
     march = 'rv32i_zicsr'
 
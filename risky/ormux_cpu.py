@@ -4,6 +4,7 @@ import operator
 
 import amaranth as am
 import amaranth.lib.enum
+import amaranth.lib.memory
 
 from risky.instruction import Instruction, Reg, Op, Funct3Alu, Funct7Alu, Funct3Branch, Funct3Mem, Funct3Csr
 import risky.memory
@@ -16,7 +17,7 @@ class MemBus(am.lib.wiring.Signature):
     name = 'mem'
 
     def __init__(self, xlen):
-        super().__init__(risky.memory.MemoryBus().flip().members)
+        super().__init__(risky.memory.memory_bus().flip().members)
 
     def __eq__(self, other):
         return self.members == other.members
@@ -125,6 +126,17 @@ class InstructionComponent(BusConnectedComponent):
     def execute(self, platform, m):
         raise NotImplementedError
 
+    # rs1 + imm out of the shared alu, for address calculations.
+    # needs AluBus in busses
+    def rs1_plus_imm(self, m, imm):
+        m.d.comb += [
+            self.alu_bus.in1.eq(self.ib.rs1),
+            self.alu_bus.in2.eq(imm),
+            self.alu_bus.op.eq(Funct3Alu.ADD_SUB),
+        ]
+
+        return self.alu_bus.out
+
 class OneHotMux(am.lib.wiring.Elaboratable):
     def __init__(self, signature):
         super().__init__()
@@ -264,7 +276,7 @@ class Cpu(am.lib.wiring.Component):
 
     def __init__(self, extensions=[]):
         super().__init__({
-            'bus': am.lib.wiring.Out(risky.memory.MemoryBus()),
+            'bus': am.lib.wiring.Out(risky.memory.memory_bus()),
         })
 
         # core state
@@ -272,15 +284,12 @@ class Cpu(am.lib.wiring.Component):
         self.pc = am.Signal(self.xlen)
         self.instr = am.Signal(Instruction)
 
-        # register file
-        regs = []
-        for i, r in enumerate(Reg):
-            assert r.value == i
-            regs.append(am.Signal(self.xlen, name='x{}_{}'.format(i, r.name.lower())))
-
-        self.regs = am.Array(regs)
+        # register file, as a memory so it can live in block ram
+        self.regfile = am.lib.memory.Memory(shape=self.xlen, depth=len(Reg), init=[0] * len(Reg))
+        self.regs = self.regfile.data
 
-        # stores the values of rs1 / rs2 from instruction fetch
+        # values of rs1 / rs2 from instruction fetch, read out of the
+        # register file
         self.rs1 = am.Signal(self.xlen)
         self.rs2 = am.Signal(self.xlen)
 
@@ -310,7 +319,8 @@ class Cpu(am.lib.wiring.Component):
     def march_base(self):
         return self.base.march
 
-    @property
+    # extensions are fixed after __init__, so these never change
+    @functools.cached_property
     def march_parts(self):
         letters = []
         words = []
@@ -326,9 +336,9 @@ class Cpu(am.lib.wiring.Component):
         letters.sort()
         words.sort()
 
-        return [self.march_base] + letters + words
+        return tuple([self.march_base] + letters + words)
 
-    @property
+    @functools.cached_property
     def march(self):
         base, *rest = self.march_parts
         for r in rest:
@@ -352,6 +362,7 @@ class Cpu(am.lib.wiring.Component):
 
         m.submodules[self.base.name] = self.base
         m.submodules.alu = self.alu
+        m.submodules.regfile = self.regfile
         for ext in self.extensions.values():
             m.submodules[ext.name] = ext
 
@@ -392,6 +403,17 @@ class Cpu(am.lib.wiring.Component):
             self.ib.stalled.eq(self.ib.wait),
         ]
 
+        # rs1 / rs2 are read when the instruction arrives, and hold after
+        rd_port = self.regfile.write_port(domain='sync')
+        rs1_port = self.regfile.read_port(domain='sync', transparent_for=[rd_port])
+        rs2_port = self.regfile.read_port(domain='sync', transparent_for=[rd_port])
+        m.d.comb += [
+            self.rs1.eq(rs1_port.data),
+            self.rs2.eq(rs2_port.data),
+            rs1_port.en.eq(0),
+            rs2_port.en.eq(0),
+        ]
+
         # core state machine
         with m.Switch(self.state):
             with m.Case(State.FETCH):
@@ -405,15 +427,19 @@ class Cpu(am.lib.wiring.Component):
                 with m.If(self.bus.ack):
                     instr = Instruction(self.mem_bus.dat_r)
                     m.d.sync += [
-                        # read register values
-                        self.rs1.eq(self.regs[instr.rs1]),
-                        self.rs2.eq(self.regs[instr.rs2]),
-
                         # execute instruction
                         self.instr.eq(instr),
                         self.state.eq(State.EXECUTE),
                     ]
 
+                    # read register values
+                    m.d.comb += [
+                        rs1_port.addr.eq(instr.rs1),
+                        rs2_port.addr.eq(instr.rs2),
+                        rs1_port.en.eq(1),
+                        rs2_port.en.eq(1),
+                    ]
+
             with m.Case(State.EXECUTE):
                 # go to next instruction
                 with m.If(~self.ib.wait):
@@ -432,11 +458,12 @@ class Cpu(am.lib.wiring.Component):
                     else:
                         m.d.sync += am.Print(info)
 
-        # writeback to rd
-        with m.If(self.ib.rd_stb):
-            # only write to non-zero registers
-            with m.If(~self.instr.rd.matches(Reg.ZERO)):
-                m.d.sync += self.regs[self.instr.rd].eq(self.ib.rd_data)
+        # writeback to rd, but only to non-zero registers
+        m.d.comb += [
+            rd_port.addr.eq(self.instr.rd),
+            rd_port.data.eq(self.ib.rd_data),
+            rd_port.en.eq(self.ib.rd_stb & ~self.instr.rd.matches(Reg.ZERO)),
+        ]
 
         return m
 
@@ -462,7 +489,7 @@ class Cpu(am.lib.wiring.Component):
             self.ib.valid,
         ]
 
-        t['registers'] = [r for r in self.regs]
+        t['registers'] = [self.regs]
 
         t['alu'] = [
             self.alu.in1,
@@ -481,6 +508,21 @@ class Cpu(am.lib.wiring.Component):
 
         return t
 
+# byte lanes a load or store of this width touches, shared by Load and Store
+def mem_sel(m, funct3_mem, lsb2):
+    sel = am.Signal(4)
+    with m.Switch(funct3_mem):
+        with m.Case(Funct3Mem.BYTE, Funct3Mem.BYTE_U):
+            m.d.comb += sel.eq(1 << lsb2)
+
+        with m.Case(Funct3Mem.HALF, Funct3Mem.HALF_U):
+            m.d.comb += sel.eq(0b11 << (lsb2 & 0b10))
+
+        with m.Default():
+            m.d.comb += sel.eq(0b1111)
+
+    return sel
+
 class Rv32i(Extension):
     march = 'rv32i'
     name = 'rv32i'
@@ -552,13 +594,15 @@ class Rv32i(Extension):
             ]
 
     class JALR(InstructionComponent):
+        busses = [InstrBus, AluBus]
+
         def always(self, platform, m):
             with m.If(self.ib.instr.op.matches(Op.JALR)):
                 with m.If(self.ib.instr.funct3.as_value() == 0):
                     m.d.comb += self.ib.valid.eq(1)
 
         def execute(self, platform, m):
-            dest = self.ib.rs1 + self.ib.instr.imm_i
+            dest = self.rs1_plus_imm(m, self.ib.instr.imm_i)
 
             m.d.comb += [
                 self.ib.rd_data.eq(self.ib.pc_next),
@@ -593,45 +637,34 @@ class Rv32i(Extension):
                 self.ib.j_rel.eq(1),
             ]
 
-            with m.Switch(self.ib.instr.funct3.branch):
-                with m.Case(Funct3Branch.EQ):
+            # the low bit of funct3 inverts the condition, so the rest
+            # only has to pick between eq, lt and ltu
+            funct3 = self.ib.instr.funct3.raw
+            cond = am.Signal(1)
+            with m.Switch(funct3[1:]):
+                with m.Case(0b00):
                     m.d.comb += [
                         self.alu_bus.op.eq(Funct3Alu.ADD_SUB),
                         self.alu_bus.alt.eq(1),
+                        cond.eq(~self.alu_bus.out.any()),
                     ]
-                    with m.If(~self.alu_bus.out.any()):
-                        m.d.comb += self.ib.j_en.eq(1)
 
-                with m.Case(Funct3Branch.NE):
+                with m.Case(0b10):
                     m.d.comb += [
-                        self.alu_bus.op.eq(Funct3Alu.ADD_SUB),
-                        self.alu_bus.alt.eq(1),
+                        self.alu_bus.op.eq(Funct3Alu.LT),
+                        cond.eq(self.alu_bus.out[0]),
                     ]
-                    with m.If(self.alu_bus.out.any()):
-                        m.d.comb += self.ib.j_en.eq(1)
 
-                with m.Case(Funct3Branch.LT):
-                    m.d.comb += self.alu_bus.op.eq(Funct3Alu.LT)
-                    with m.If(self.alu_bus.out[0]):
-                        m.d.comb += self.ib.j_en.eq(1)
-
-                with m.Case(Funct3Branch.GE):
-                    m.d.comb += self.alu_bus.op.eq(Funct3Alu.LT)
-                    with m.If(~self.alu_bus.out[0]):
-                        m.d.comb += self.ib.j_en.eq(1)
-
-                with m.Case(Funct3Branch.LTU):
-                    m.d.comb += self.alu_bus.op.eq(Funct3Alu.LTU)
-                    with m.If(self.alu_bus.out[0]):
-                        m.d.comb += self.ib.j_en.eq(1)
+                with m.Case(0b11):
+                    m.d.comb += [
+                        self.alu_bus.op.eq(Funct3Alu.LTU),
+                        cond.eq(self.alu_bus.out[0]),
+                    ]
 
-                with m.Case(Funct3Branch.GEU):
-                    m.d.comb += self.alu_bus.op.eq(Funct3Alu.LTU)
-                    with m.If(~self.alu_bus.out[0]):
-                        m.d.comb += self.ib.j_en.eq(1)
+            m.d.comb += self.ib.j_en.eq(cond ^ funct3[0])
 
     class Load(InstructionComponent):
-        busses = [InstrBus, MemBus]
+        busses = [InstrBus, AluBus, MemBus]
 
         def always(self, platform, m):
             with m.If(self.ib.instr.op.matches(Op.LOAD)):
@@ -645,41 +678,22 @@ class Rv32i(Extension):
                     m.d.comb += self.ib.valid.eq(1)
 
         def execute(self, platform, m):
-            dest = self.ib.rs1 + self.ib.instr.imm_i
+            dest = self.rs1_plus_imm(m, self.ib.instr.imm_i)
             m.d.comb += [
                 self.mem_bus.adr.eq(dest[2:]),
                 self.mem_bus.cyc.eq(1),
                 self.mem_bus.stb.eq(1),
+                self.mem_bus.sel.eq(mem_sel(m, self.ib.instr.funct3.mem, dest[:2])),
             ]
 
-            with m.Switch(self.ib.instr.funct3.mem):
-                with m.Case(Funct3Mem.BYTE, Funct3Mem.BYTE_U):
-                    m.d.comb += self.mem_bus.sel.eq(1 << dest[:2])
-
-                with m.Case(Funct3Mem.HALF, Funct3Mem.HALF_U):
-                    m.d.comb += self.mem_bus.sel.eq(0b11 << (dest[:2] & 0b10))
-
-                with m.Default():
-                    m.d.comb += self.mem_bus.sel.eq(0b1111)
-
             with m.If(self.mem_bus.ack):
                 # load the data
                 data = self.mem_bus.dat_r
 
-                # shift data
-                shift = am.Mux(
-                        self.ib.instr.funct3.mem == Funct3Mem.WORD,
-                        0,
-                        dest[:2],
-                    )
-                shift &= am.Mux(
-                    self.ib.instr.funct3.mem.matches(Funct3Mem.HALF, Funct3Mem.HALF_U),
-                    0b10,
-                    0b11,
-                )
-                data = data >> (shift << 3)
-
-                # mask data by sel
+                # pick out the lane we want. there's only four places a
+                # byte can be, so a mux does this without a shifter
+                byte = data.word_select(dest[:2], 8)
+                half = data.word_select(dest[1], 16)
                 mask = am.Mux(
                     self.ib.instr.funct3.mem.matches(Funct3Mem.BYTE, Funct3Mem.BYTE_U),
                     0x0000_00ff,
@@ -689,15 +703,23 @@ class Rv32i(Extension):
                         0xffff_ffff,
                     ),
                 )
-                data &= mask
+                data = am.Mux(
+                    self.ib.instr.funct3.mem.matches(Funct3Mem.BYTE, Funct3Mem.BYTE_U),
+                    byte,
+                    am.Mux(
+                        self.ib.instr.funct3.mem.matches(Funct3Mem.HALF, Funct3Mem.HALF_U),
+                        half,
+                        data,
+                    ),
+                )
 
                 # sign extend data
                 sign = am.Mux(
                     self.ib.instr.funct3.mem.matches(Funct3Mem.BYTE),
-                    data[7],
+                    byte[7],
                     am.Mux(
                         self.ib.instr.funct3.mem.matches(Funct3Mem.HALF),
-                        data[15],
+                        half[15],
                         0,
                     ),
                 )
@@ -714,7 +736,7 @@ class Rv32i(Extension):
                 m.d.comb += self.ib.wait.eq(1)
 
     class Store(InstructionComponent):
-        busses = [InstrBus, MemBus]
+        busses = [InstrBus, AluBus, MemBus]
 
         def always(self, platform, m):
             with m.If(self.ib.instr.op.matches(Op.STORE)):
@@ -727,13 +749,14 @@ class Rv32i(Extension):
 
         def execute(self, platform, m):
             src = self.ib.rs2
-            dest = self.ib.rs1 + self.ib.instr.imm_s
+            dest = self.rs1_plus_imm(m, self.ib.instr.imm_s)
 
             m.d.comb += [
                 self.mem_bus.adr.eq(dest[2:]),
                 self.mem_bus.cyc.eq(1),
                 self.mem_bus.stb.eq(1),
                 self.mem_bus.we.eq(1),
+                self.mem_bus.sel.eq(mem_sel(m, self.ib.instr.funct3.mem, dest[:2])),
             ]
 
             # wait here until ack
@@ -741,45 +764,26 @@ class Rv32i(Extension):
                 m.d.comb += self.ib.wait.eq(1)
 
             # this is fiddled with in the cases later
-            m.d.comb += self.mem_bus.dat_w.eq(am.Cat(src[:16], src[:16]))
+            m.d.comb += self.mem_bus.dat_w.eq(src[:16].replicate(2))
 
             with m.Switch(self.ib.instr.funct3.mem):
                 with m.Case(Funct3Mem.BYTE):
-                    m.d.comb += [
-                        self.mem_bus.dat_w[8:16].eq(src[:8]),
-                        self.mem_bus.dat_w[24:32].eq(src[:8]),
-                        self.mem_bus.sel.eq(1 << dest[:2]),
-                    ]
+                    m.d.comb += self.mem_bus.dat_w.eq(src[:8].replicate(4))
 
-                with m.Case(Funct3Mem.HALF):
-                    m.d.comb += [
-                        self.mem_bus.sel.eq(0b11 << (dest[:2] & 0b10)),
-                    ]
-
-                with m.Default():
-                    m.d.comb += [
-                        self.mem_bus.dat_w[16:32].eq(src[16:32]),
-                        self.mem_bus.sel.eq(0b1111),
-                    ]
+                with m.Case(Funct3Mem.WORD):
+                    m.d.comb += self.mem_bus.dat_w[16:32].eq(src[16:32])
 
     class OpImm(InstructionComponent):
         busses = [InstrBus, AluBus]
 
         def always(self, platform, m):
+            # only shifts have a funct7 here, and only SHIFT_R has an alt
+            funct3 = self.ib.instr.funct3.alu
+            normal = self.ib.instr.funct7.alu.matches(Funct7Alu.NORMAL)
+            alt = self.ib.instr.funct7.alu.matches(Funct7Alu.ALT)
             with m.If(self.ib.instr.op.matches(Op.OP_IMM)):
-                with m.Switch(self.ib.instr.funct3.alu):
-                    with m.Case(Funct3Alu.SHIFT_L):
-                        with m.If(self.ib.instr.funct7.alu.matches(Funct7Alu.NORMAL)):
-                            m.d.comb += self.ib.valid.eq(1)
-
-                    with m.Case(Funct3Alu.SHIFT_R):
-                        with m.If(self.ib.instr.funct7.alu.matches(Funct7Alu.NORMAL)):
-                            m.d.comb += self.ib.valid.eq(1)
-                        with m.Elif(self.ib.instr.funct7.alu.matches(Funct7Alu.ALT)):
-                            m.d.comb += self.ib.valid.eq(1)
-
-                    with m.Default():
-                        m.d.comb += self.ib.valid.eq(1)
+                with m.If(~funct3.matches(Funct3Alu.SHIFT_L, Funct3Alu.SHIFT_R) | normal | (alt & funct3.matches(Funct3Alu.SHIFT_R))):
+                    m.d.comb += self.ib.valid.eq(1)
 
         def execute(self, platform, m):
             m.d.comb += [
@@ -801,17 +805,13 @@ class Rv32i(Extension):
         busses = [InstrBus, AluBus]
 
         def always(self, platform, m):
+            # only ADD_SUB and SHIFT_R have an alt
+            funct3 = self.ib.instr.funct3.alu
+            normal = self.ib.instr.funct7.alu.matches(Funct7Alu.NORMAL)
+            alt = self.ib.instr.funct7.alu.matches(Funct7Alu.ALT)
             with m.If(self.ib.instr.op.matches(Op.OP)):
-                with m.If(self.ib.instr.funct3.alu.matches(Funct3Alu.ADD_SUB, Funct3Alu.SHIFT_R)):
-                    with m.If(self.ib.instr.funct7.alu.matches(Funct7Alu.NORMAL)):
-                        m.d.comb += self.ib.valid.eq(1)
-
-                    with m.Elif(self.ib.instr.funct7.alu.matches(Funct7Alu.ALT)):
-                        m.d.comb += self.ib.valid.eq(1)
-
-                with m.Else():
-                    with m.If(self.ib.instr.funct7.alu.matches(Funct7Alu.NORMAL)):
-                        m.d.comb += self.ib.valid.eq(1)
+                with m.If(normal | (alt & funct3.matches(Funct3Alu.ADD_SUB, Funct3Alu.SHIFT_R))):
+                    m.d.comb += self.ib.valid.eq(1)
 
         def execute(self, platform, m):
             m.d.comb += [
@@ -856,10 +856,12 @@ class Alu(am.lib.wiring.Component):
             self.lt.eq(am.Mux(self.in1[-1] ^ self.in2[-1], self.in1[-1], self.minus[-1])),
         ]
 
-        # shared shifter for ll / rl / ra
-        shift_in = am.Mux(self.op.matches(Funct3Alu.SHIFT_L), self.in1[::-1], self.in1)
-        rightshift = am.Cat(shift_in, self.alt & shift_in[-1]).as_signed() >> (self.in2 & (self.xlen - 1))
-        leftshift = rightshift[:-1][::-1]
+        # one shifter each way. arithmetic right shifts fill from the
+        # top with the sign bit, logical ones with zero
+        shamt = self.in2[:(self.xlen - 1).bit_length()]
+        fill = self.alt & self.in1[-1]
+        rightshift = (am.Cat(self.in1, fill.replicate(self.xlen)) >> shamt)[:self.xlen]
+        leftshift = (self.in1 << shamt)[:self.xlen]
 
         # ok, now push the right one to out
         with m.Switch(self.op):
@@ -1031,15 +1033,24 @@ class Zicntr(Extension):
         self.time = self.cycle # a valid implementation of time
         self.instret = am.Signal(64)
 
+    def count(self, m, counter, enable):
+        # split the counter in halves, so the high half only needs to
+        # increment when the low half carries out
+        half = len(counter) // 2
+        low = am.Signal(half + 1)
+        m.d.comb += low.eq(counter[:half] + enable)
+        m.d.sync += counter[:half].eq(low[:half])
+        with m.If(low[-1]):
+            m.d.sync += counter[half:].eq(counter[half:] + 1)
+
     def elaborate(self, platform):
         m = am.Module()
 
         # cycle is easy
-        m.d.sync += self.cycle.eq(self.cycle + 1)
+        self.count(m, self.cycle, 1)
 
         # instret is also easy enough
-        with m.If(self.ib.execute & ~self.ib.stalled):
-            m.d.sync += self.instret.eq(self.instret + 1)
+        self.count(m, self.instret, self.ib.execute & ~self.ib.stalled)
 
         with m.Switch(self.csr_bus.adr):
             with m.Case(0xc00):
@@ -0,0 +1,180 @@
+from risky.instruction import Op, Funct3Alu, Funct3Branch, Funct3Mem
+
+# a plain RV32I model of the base Cpu, for running programs much faster
+# than simulating the hdl does, and checking the hdl against.
+# where the spec leaves room, this does what Cpu does: ebreak stops,
+# misaligned accesses round down to the lane, and anything Cpu considers
+# a bad instruction is an error here. that includes ecall, which Cpu
+# doesn't implement yet
+
+MASK = 0xffff_ffff
+
+EBREAK = 0b000000000001_00000_000_00000_1110011
+
+def sext(value, bits):
+    sign = 1 << (bits - 1)
+    return ((value & (sign - 1)) - (value & sign)) & MASK
+
+def signed(value):
+    return value - (1 << 32) if value & (1 << 31) else value
+
+def alu(funct3, alt, a, b):
+    shamt = b & 0b11111
+    match Funct3Alu(funct3):
+        case Funct3Alu.ADD_SUB:
+            return (a - b if alt else a + b) & MASK
+        case Funct3Alu.SHIFT_L:
+            return (a << shamt) & MASK
+        case Funct3Alu.LT:
+            return int(signed(a) < signed(b))
+        case Funct3Alu.LTU:
+            return int(a < b)
+        case Funct3Alu.XOR:
+            return a ^ b
+        case Funct3Alu.SHIFT_R:
+            return (signed(a) >> shamt) & MASK if alt else a >> shamt
+        case Funct3Alu.OR:
+            return a | b
+        case Funct3Alu.AND:
+            return a & b
+
+class Machine:
+    def __init__(self, program, base=0, size=None):
+        if size is None:
+            size = len(program)
+
+        self.base = base
+        self.mem = bytearray(program) + bytearray(max(0, size - len(program)))
+        self.regs = [0] * 32
+        self.pc = base
+        self.instret = 0
+        self.halted = False
+
+    def _offset(self, addr, width):
+        # the bus only sees word addresses, and sel picks the lanes
+        offset = (addr & ~(width - 1)) - self.base
+        if offset < 0 or offset + width > len(self.mem):
+            raise RuntimeError('memory access out of range: 0x{:08x}'.format(addr))
+        return offset
+
+    def load(self, addr, width):
+        offset = self._offset(addr, width)
+        return int.from_bytes(self.mem[offset:offset + width], 'little')
+
+    def store(self, addr, width, value):
+        offset = self._offset(addr, width)
+        self.mem[offset:offset + width] = (value & ((1 << (8 * width)) - 1)).to_bytes(width, 'little')
+
+    def bad_instruction(self, instr):
+        raise RuntimeError('bad instruction: pc = 0x{:08x}, 0x{:08x}'.format(self.pc, instr))
+
+    def step(self):
+        if self.halted:
+            return
+
+        instr = self.load(self.pc, 4)
+        op = instr & 0b1111111
+        rd = (instr >> 7) & 0b11111
+        funct3 = (instr >> 12) & 0b111
+        rs1 = self.regs[(instr >> 15) & 0b11111]
+        rs2 = self.regs[(instr >> 20) & 0b11111]
+        funct7 = instr >> 25
+        alt = funct7 == 0b0100000
+
+        imm_i = sext(instr >> 20, 12)
+        imm_s = sext((funct7 << 5) | rd, 12)
+        imm_b = sext(((instr >> 31) << 12) | (((instr >> 7) & 1) << 11) | (((instr >> 25) & 0b111111) << 5) | (((instr >> 8) & 0b1111) << 1), 13)
+        imm_u = instr & 0xffff_f000
+        imm_j = sext(((instr >> 31) << 20) | (((instr >> 12) & 0xff) << 12) | (((instr >> 20) & 1) << 11) | (((instr >> 21) & 0x3ff) << 1), 21)
+
+        pc_next = (self.pc + 4) & MASK
+        result = None
+
+        match op:
+            case Op.LUI.value:
+                result = imm_u
+
+            case Op.AUIPC.value:
+                result = (self.pc + imm_u) & MASK
+
+            case Op.JAL.value:
+                result = pc_next
+                pc_next = (self.pc + imm_j) & MASK
+
+            case Op.JALR.value:
+                if funct3 != 0:
+                    self.bad_instruction(instr)
+                result = pc_next
+                pc_next = (rs1 + imm_i) & MASK & ~1
+
+            case Op.BRANCH.value:
+                match funct3:
+                    case Funct3Branch.EQ.value | Funct3Branch.NE.value:
+                        cond = rs1 == rs2
+                    case Funct3Branch.LT.value | Funct3Branch.GE.value:
+                        cond = signed(rs1) < signed(rs2)
+                    case Funct3Branch.LTU.value | Funct3Branch.GEU.value:
+                        cond = rs1 < rs2
+                    case _:
+                        self.bad_instruction(instr)
+
+                # odd funct3 inverts the condition
+                if cond != bool(funct3 & 1):
+                    pc_next = (self.pc + imm_b) & MASK
+
+            case Op.LOAD.value:
+                addr = (rs1 + imm_i) & MASK
+                match funct3:
+                    case Funct3Mem.BYTE.value:
+                        result = sext(self.load(addr, 1), 8)
+                    case Funct3Mem.HALF.value:
+                        result = sext(self.load(addr, 2), 16)
+                    case Funct3Mem.WORD.value:
+                        result = self.load(addr, 4)
+                    case Funct3Mem.BYTE_U.value:
+                        result = self.load(addr, 1)
+                    case Funct3Mem.HALF_U.value:
+                        result = self.load(addr, 2)
+                    case _:
+                        self.bad_instruction(instr)
+
+            case Op.STORE.value:
+                if funct3 > Funct3Mem.WORD.value:
+                    self.bad_instruction(instr)
+                self.store((rs1 + imm_s) & MASK, 1 << funct3, rs2)
+
+            case Op.OP_IMM.value:
+                # only shifts have a funct7, and only SHIFT_R has an alt
+                if funct3 == Funct3Alu.SHIFT_L.value and funct7 != 0:
+                    self.bad_instruction(instr)
+                if funct3 == Funct3Alu.SHIFT_R.value and funct7 not in (0, 0b0100000):
+                    self.bad_instruction(instr)
+                is_shift = funct3 in (Funct3Alu.SHIFT_L.value, Funct3Alu.SHIFT_R.value)
+                result = alu(funct3, alt and is_shift, rs1, imm_i)
+
+            case Op.OP.value:
+                if funct7 != 0 and not (alt and funct3 in (Funct3Alu.ADD_SUB.value, Funct3Alu.SHIFT_R.value)):
+                    self.bad_instruction(instr)
+                result = alu(funct3, alt, rs1, rs2)
+
+            case Op.SYSTEM.value if instr == EBREAK:
+                # Cpu stalls here forever, so stop
+                self.halted = True
+                return
+
+            case _:
+                self.bad_instruction(instr)
+
+        if result is not None and rd != 0:
+            self.regs[rd] = result
+        self.pc = pc_next
+        self.instret += 1
+
+    def run(self, max_instr):
+        while not self.halted and self.instret < max_instr:
+            self.step()
+
+def run(program, max_instr, base=0, size=None):
+    machine = Machine(program, base=base, size=size)
+    machine.run(max_instr)
+    return (machine.regs, machine.pc, machine.instret)
@@ -55,7 +55,7 @@ class Soc(am.lib.wiring.Component):
     copi: am.lib.wiring.Out(1)
     cipo: am.lib.wiring.In(1)
 
-    def __init__(self, clk_freq, cpu=None, memory_contents=b'', bootloader=True):
+    def __init__(self, clk_freq, cpu=None, memory_contents=b'', bootloader=True, pipelined_memory=False):
         super().__init__()
 
         self.clk_freq = clk_freq
@@ -73,7 +73,10 @@ class Soc(am.lib.wiring.Component):
             #])
 
         self.cpu = cpu
-        self.memory = risky.memory.MemoryMap(alignment=28)
+        self.memory = risky.memory.MemoryMap(alignment=28, pipelined=pipelined_memory)
+
+        # generated sources, kept with the resource tree they came from
+        self.generated = {}
 
         # 4K bootloader rom
         if bootloader:
@@ -96,7 +99,7 @@ class Soc(am.lib.wiring.Component):
 
         if bootloader:
             with self.compiler(bootloader=True) as c:
-                c.add(c.copy_runtime_file('bootloader.c'))
+                c.add(c.runtime_file('bootloader.c'))
                 elf = c.link()
 
                 #elf.dump('bootloader.elf')
@@ -115,7 +118,21 @@ class Soc(am.lib.wiring.Component):
         m.submodules.cpu = self.cpu
         m.submodules.memory = self.memory
 
-        am.lib.wiring.connect(m, self.cpu.bus, self.memory.bus)
+        if getattr(self.cpu, 'simple_bus', False):
+            # bridge the cpu's simple bus back onto wishbone
+            mem = self.cpu.mem
+            m.d.comb += [
+                self.memory.bus.adr.eq(mem.addr),
+                self.memory.bus.cyc.eq(mem.req),
+                self.memory.bus.stb.eq(mem.req),
+                self.memory.bus.we.eq(mem.we),
+                self.memory.bus.sel.eq(mem.sel),
+                self.memory.bus.dat_w.eq(mem.data_w),
+                mem.data_r.eq(self.memory.bus.dat_r),
+                mem.ready.eq(self.memory.bus.ack),
+            ]
+        else:
+            am.lib.wiring.connect(m, self.cpu.bus, self.memory.bus)
 
         m.d.comb += [
             self.uart.rx.eq(self.rx),
@@ -147,7 +164,7 @@ class Soc(am.lib.wiring.Component):
             self.spi.cipo,
         ]
 
-        if getattr(self, sha1):
+        if hasattr(self, 'sha1'):
             t['sha1'] = self.sha1.debug_traces
 
         return t
@@ -236,44 +253,65 @@ class Soc(am.lib.wiring.Component):
         print('loading binaries:', *fnames)
         return cls.with_binaries(clk_freq, *fnames)
 
+    # generated sources only depend on the memory map, so reuse them
+    # for as long as its resource tree is the same one
+    def cached_source(self, key, generate):
+        tree = self.memory.get_resource_tree()
+        cached = self.generated.get(key)
+        if cached is None or cached[0] is not tree:
+            cached = (tree, generate(tree))
+            self.generated[key] = cached
+        return cached[1]
+
     def generate_memory_x(self, bootloader=False):
-        memory_x = 'MEMORY\n{\n'
-        for n, children in self.memory.get_resource_tree().walk():
+        return self.cached_source(('memory.x', bootloader), lambda tree: self.build_memory_x(tree, bootloader))
+
+    def build_memory_x(self, tree, bootloader):
+        lines = ['MEMORY', '{']
+        for n, children in tree.walk():
             if n.memory_x_access:
                 children.clear()
-                memory_x += '    {} ({}) : ORIGIN = 0x{:x}, LENGTH = {}\n'.format(
+                lines.append('    {} ({}) : ORIGIN = 0x{:x}, LENGTH = {}'.format(
                     '_'.join(n.path).upper(),
                     n.memory_x_access,
                     n.start,
                     n.size,
-                )
-        memory_x += '}\n'
+                ))
+        lines.append('}')
 
-        memory_x += '\n'
+        lines.append('')
 
         code_region = 'ROM'
         if bootloader:
             code_region = 'BOOTLOADER'
 
-        memory_x += 'REGION_ALIAS("REGION_TEXT", {});\n'.format(code_region)
-        memory_x += 'REGION_ALIAS("REGION_RODATA", {});\n'.format(code_region)
-        memory_x += 'REGION_ALIAS("REGION_DATA", RAM);\n'
-        memory_x += 'REGION_ALIAS("REGION_BSS", RAM);\n'
-        memory_x += 'REGION_ALIAS("REGION_HEAP", RAM);\n'
-        memory_x += 'REGION_ALIAS("REGION_STACK", RAM);\n'
+        lines.append('REGION_ALIAS("REGION_TEXT", {});'.format(code_region))
+        lines.append('REGION_ALIAS("REGION_RODATA", {});'.format(code_region))
+        lines.append('REGION_ALIAS("REGION_DATA", RAM);')
+        lines.append('REGION_ALIAS("REGION_BSS", RAM);')
+        lines.append('REGION_ALIAS("REGION_HEAP", RAM);')
+        lines.append('REGION_ALIAS("REGION_STACK", RAM);')
 
-        return memory_x
+        return '\n'.join(lines) + '\n'
 
     def generate_header(self):
-        h = ''
-        h += '#ifndef __RISKY_H_INCLUDED\n'
-        h += '#define __RISKY_H_INCLUDED\n\n'
+        return self.cached_source(('risky.h',), self.build_header)
+
+    def build_header(self, tree):
+        lines = []
+        lines.append('#ifndef __RISKY_H_INCLUDED')
+        lines.append('#define __RISKY_H_INCLUDED')
+        lines.append('')
 
-        h += '#if !defined(__ASSEMBLER__)\n'
-        h += '#include <stdint.h>\n'
-        h += '#endif\n\n'
+        lines.append('#if !defined(__ASSEMBLER__)')
+        lines.append('#include <stdint.h>')
+        lines.append('#endif')
+        lines.append('')
 
-        for n, _ in self.memory.get_resource_tree().walk():
+        def define(name, fmt, *args, **kwargs):
+            lines.append('#define {:<40} '.format(name) + fmt.format(*args, **kwargs))
+
+        for n, _ in tree.walk():
             if not n.path:
                 continue
 
@@ -282,16 +320,28 @@ class Soc(am.lib.wiring.Component):
 
             leaf = '_ADDR' if n.resource else '_BASE'
 
-            def define(name, fmt, *args, **kwargs):
-                nonlocal h
-                h += '#define {:<40} '.format(name) + fmt.format(*args, **kwargs) + '\n'
-
             if len(n.path) == 1:
                 define(name + leaf, '0x{:08x}', n.start)
             else:
                 define(name + leaf, '({}_BASE + 0x{:x})', parent, n.offset)
 
             define(name + '_SIZE', '0x{:x}', n.size)
+
+            # register groups also get a struct, so they can be passed
+            # around and accessed as a whole
+            members = n.c_struct_members
+            if members:
+                lines.append('#if !defined(__ASSEMBLER__)')
+                lines.append('typedef struct {')
+                for c_type, member, count in members:
+                    if count is None:
+                        lines.append('    volatile {} {};'.format(c_type, member))
+                    else:
+                        lines.append('    volatile {} {}[{}];'.format(c_type, member, count))
+                lines.append('}} {}_t;'.format(name))
+                define(name, '(*(volatile {0}_t *){0}_BASE)', name)
+                lines.append('#endif')
+
             if n.resource and n.c_type:
                 define(name, '(*(volatile {} *){}{})', n.c_type, name, leaf)
                 if isinstance(n.resource, amaranth_soc.csr.Register):
@@ -305,16 +355,16 @@ class Soc(am.lib.wiring.Component):
                         field_size = fv.port.shape.width
                         field_end = field_start + field_size
 
-                        h += '\n'
+                        lines.append('')
                         define(fieldname + '_SHIFT', '{}', field_start)
                         define(fieldname + '_WIDTH', '{}', field_size)
                         define(fieldname + '_MASK', '(((1 << {0}_WIDTH) - 1) << {0}_SHIFT)', fieldname)
 
                         field_start = field_end
-            h += '\n'
+            lines.append('')
 
-        h += '#endif /* __RISKY_H_INCLUDED */\n'
-        return h
+        lines.append('#endif /* __RISKY_H_INCLUDED */')
+        return '\n'.join(lines) + '\n'
 
     def generate_svd(self):
         root = ET.Element('device')
@@ -10,14 +10,23 @@ import risky.soc
 class Simulated:
     clk_freq = 1_000_000
 
+    # any engine amaranth.sim.Simulator accepts, by name or class
+    engine = 'pysim'
+
+    # names of the debug_traces categories to write out, or None for all.
+    # every traced signal costs time on every change, so fewer is faster
+    trace_categories = None
+
     def run(self, output=None, gtkw_file=None):
         self.dut = self.construct()
-        self.sim = am.sim.Simulator(self.dut)
+        self.sim = am.sim.Simulator(self.dut, engine=self.engine)
         self.sim.add_clock(1 / self.clk_freq)
         self.sim.add_testbench(self.testbench)
 
         if output:
             traces = self.dut.debug_traces
+            if self.trace_categories is not None:
+                traces = {k: v for k, v in traces.items() if k in self.trace_categories}
             with self.sim.write_vcd(output, gtkw_file=gtkw_file, traces=traces):
                 self.sim.run()
         else:
@@ -39,11 +48,23 @@ class ProgramTest(Simulated):
 
     PROGRAM = None
 
+    # C source built alongside PROGRAM, which can call into it
+    C_PROGRAM = None
+
     CHECKPOINTS = []
 
-    def __init__(self, cpu):
+    # extra arguments for the Soc the program runs on
+    SOC_KWARGS = {}
+
+    # extensions the cpu needs for this test to run, by lowercase name
+    REQUIRES = ()
+
+    def __init__(self, cpu, compiler_dir=None, engine=None):
         super().__init__()
         self.cpu = cpu
+        self.compiler_dir = compiler_dir
+        if engine is not None:
+            self.engine = engine
 
     @property
     def name(self):
@@ -51,19 +72,24 @@ class ProgramTest(Simulated):
 
     @classmethod
     def iter_tests(cls, cpu, filter=lambda t: True):
+        extensions = {name.lower() for name in getattr(cpu, 'extensions', {})}
         for subclass in cls.__subclasses__():
+            if not extensions.issuperset(subclass.REQUIRES):
+                continue
             if subclass.PROGRAM:
                 t = subclass(cpu)
                 if filter(t):
                     yield t
 
     def construct(self):
-        dut = risky.soc.Soc(self.clk_freq, cpu=self.cpu, bootloader=False)
+        dut = risky.soc.Soc(self.clk_freq, cpu=self.cpu, bootloader=False, **self.SOC_KWARGS)
         dut.cpu.assert_unknown_instructions = True
 
-        with dut.compiler(runtime=False, optimize=False) as c:
-            c.add_source('s', self.HEADER + '\n' + self.PROGRAM)
-            self.elf = c.link()
+        with dut.compiler(runtime=False, optimize=False, parent_dir=self.compiler_dir) as c:
+            sources = [c.write_source('s', self.HEADER + '\n' + self.PROGRAM)]
+            if self.C_PROGRAM:
+                sources.append(c.write_source('c', self.C_PROGRAM))
+            self.elf = c.build_single_shot(sources)
 
         dut.set_program(self.elf.flat)
         self.symbols = self.elf.symbols()
@@ -125,6 +151,12 @@ class ProgramTest(Simulated):
         else:
             addr = addr_or_symbol
 
+        # every cpu here comes back to its fetch state once per
+        # instruction, so counting those counts the instructions run on
+        # the way. that holds because the soc's memories ack a cycle
+        # after the request. Cpu can skip FETCH_INSTR when an ack comes
+        # in the same cycle, and this would undercount on such a memory
+        instructions = 0
         for _ in range(max_ticks):
             prev_state = ctx.get(self.dut.cpu.state)
 
@@ -134,8 +166,10 @@ class ProgramTest(Simulated):
             pc = ctx.get(self.dut.cpu.pc)
             state = ctx.get(self.dut.cpu.state)
 
-            if pc == addr and state == risky.cpu.State.FETCH_INSTR.value and state != prev_state:
-                return
+            if state == risky.cpu.State.FETCH_INSTR.value and state != prev_state:
+                instructions += 1
+                if pc == addr:
+                    return instructions
 
         if isinstance(addr_or_symbol, str):
             name = addr_or_symbol
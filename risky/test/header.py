@@ -0,0 +1,26 @@
+import risky.test
+
+class Header(risky.test.ProgramTest):
+    # build against the generated risky.h, and use one of its register
+    # structs, here the gpio output with its numbered register
+    C_PROGRAM = """
+    #include "risky.h"
+
+    uint32_t leds_roundtrip(uint32_t value) {
+        IO_LEDS.R0 = value;
+        return IO_LEDS.R0;
+    }
+    """
+
+    PROGRAM = """
+    la sp, _stack_start
+    li a0, 0x5a
+    call leds_roundtrip
+    a:
+    """
+
+    TIMEOUT = 500
+
+    CHECKPOINTS = [
+        ('a', {'a0': 0x5a}),
+    ]
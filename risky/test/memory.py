@@ -0,0 +1,36 @@
+import risky.test
+
+class PipelinedMemory(risky.test.ProgramTest):
+    # every fetch, load, and store goes through the registered stage in
+    # front of the decoder, fetches back to back with everything else
+    PROGRAM = """
+    la a2, dest
+    li a0, 0x12345678
+    sw a0, 0(a2)
+    lw a1, 0(a2)
+    sb a0, 5(a2)
+    sh a0, 6(a2)
+    lw a3, 4(a2)
+    lbu a4, 6(a2)
+    a:
+
+    .section .bss
+    dest:
+    .word 0
+    dest_hi:
+    .word 0
+    """
+
+    SOC_KWARGS = {'pipelined_memory': True}
+
+    TIMEOUT = 500
+
+    CHECKPOINTS = [
+        ('a', {
+            'a1': 0x1234_5678,
+            'a3': 0x5678_7800,
+            'a4': 0x78,
+            'memory.dest': 0x1234_5678,
+            'memory.dest_hi': 0x5678_7800,
+        }),
+    ]
@@ -11,10 +11,12 @@ import risky.soc
 import risky.test
 
 class Plain(risky.test.Simulated):
-    def __init__(self, sources, cycles=None, boot=True):
+    def __init__(self, sources, cycles=None, boot=True, trace_categories=None):
         self.sources = sources
         self.cycles = cycles
         self.boot = boot
+        if trace_categories is not None:
+            self.trace_categories = trace_categories
 
         super().__init__()
 
@@ -0,0 +1,79 @@
+import risky.refmodel
+import risky.test
+
+class RefModel(risky.test.ProgramTest):
+    # a bit of everything, checked against risky.refmodel instead of by
+    # hand. the model only has one memory, so this stays inside rom
+    PROGRAM = """
+    li a0, 0x12345678
+    li a1, -7
+    add a2, a0, a1
+    sub a3, a0, a1
+    sll a4, a0, a1
+    srai a5, a1, 1
+    srl t0, a1, a0
+    slt t1, a1, a0
+    sltu t2, a1, a0
+    xori s0, a0, -1
+    or s1, a0, a1
+    and s2, a0, a1
+
+    la t3, scratch
+    sw a0, 0(t3)
+    sh a1, 4(t3)
+    sb a0, 7(t3)
+    lw t4, 0(t3)
+    lh t5, 4(t3)
+    lbu t6, 7(t3)
+    lb s3, 5(t3)
+
+    li s4, 5
+    loop:
+    addi s4, s4, -1
+    add s5, s5, a0
+    bnez s4, loop
+
+    bltu a0, a1, skip
+    li s6, 1
+    skip:
+    bge a0, a1, over
+    li s6, 2
+    over:
+
+    jal ra, func
+    auipc s8, 0
+    lui s9, 0xabcde
+    j done
+
+    func:
+    addi s7, zero, 42
+    ret
+
+    .align 2
+    scratch:
+    .word 0, 0
+
+    done:
+    ebreak
+    """
+
+    TIMEOUT = 2000
+
+    async def testbench(self, ctx):
+        # the hdl stops at done, before running the ebreak, which is
+        # where the model halts too
+        instret = await self.advance_until(ctx, 'done')
+
+        base = self.dut.memory.get_resource_tree().children['rom'].start
+        size = self.dut.rom.depth * (self.dut.rom.bus.data_width // 8)
+        regs, pc, expected_instret = risky.refmodel.run(self.elf.flat, self.TIMEOUT, base=base, size=size)
+
+        if pc != self.symbols['done']:
+            raise RuntimeError('reference model stopped at 0x{:08x}'.format(pc))
+        self.assert_eq(ctx, 'pc', pc)
+
+        for i, value in enumerate(regs):
+            self.assert_eq(ctx, 'regs.{}'.format(i), value)
+
+        if instret != expected_instret:
+            raise RuntimeError('bad instruction count (expected {}, got {})'.format(expected_instret, instret))
@@ -0,0 +1,120 @@
+import os
+import os.path
+import shutil
+import subprocess
+
+import risky.test
+
+# drives the converted design: clocks it, optionally boots it through
+# the bootloader like Plain does, and lets the uart's $write calls
+# print straight to stdout
+HARNESS = """
+#include <cstdio>
+#include <cstdlib>
+#include <cstring>
+
+#include "verilated.h"
+#include "Vtop.h"
+
+static const unsigned long DIVISOR = {divisor};
+
+static VerilatedContext *ctx;
+static Vtop *top;
+static long long cycle = 0;
+
+static void tick() {{
+    top->clk = 0;
+    top->eval();
+    top->clk = 1;
+    top->eval();
+    cycle++;
+}}
+
+static void send_data(const char *data) {{
+    for (const char *c = data; *c; c++) {{
+        // start bit, 8 data bits lsb first, stop bit
+        int bits = (1 << 9) | ((unsigned char)*c << 1);
+        for (int i = 0; i < 10; i++) {{
+            top->rx = (bits >> i) & 1;
+            for (unsigned long j = 0; j < DIVISOR; j++)
+                tick();
+        }}
+    }}
+}}
+
+int main(int argc, char **argv) {{
+    // usage: risky-sim <cycles, or -1 for forever> <boot, 0 or 1>
+    long long cycles = argc > 1 ? atoll(argv[1]) : -1;
+    bool boot = argc > 2 ? atoi(argv[2]) : 1;
+
+    setvbuf(stdout, NULL, _IONBF, 0);
+
+    ctx = new VerilatedContext;
+    top = new Vtop{{ctx}};
+
+    top->rx = 1;
+    top->cipo = 0;
+
+    top->rst = 1;
+    tick();
+    top->rst = 0;
+
+    if (boot) {{
+        // wait until the bootloader is alive, then send boot command
+        while (top->tx && !ctx->gotFinish())
+            tick();
+        send_data("b\\n");
+    }}
+
+    while ((cycles < 0 || cycle < cycles) && !ctx->gotFinish())
+        tick();
+
+    top->final();
+    delete top;
+    delete ctx;
+    return 0;
+}}
+"""
+
+class Verilated:
+    clk_freq = risky.test.Simulated.clk_freq
+    baud = 115200
+
+    def __init__(self, verilog, build_dir):
+        self.verilog = verilog
+        self.build_dir = build_dir
+        self.binary = os.path.join(self.build_dir, 'obj', 'risky-sim')
+
+    def build(self):
+        verilator = shutil.which('verilator')
+        if verilator is None:
+            raise RuntimeError('verilator not found in PATH')
+
+        os.makedirs(self.build_dir, exist_ok=True)
+
+        top_v = os.path.join(self.build_dir, 'top.v')
+        with open(top_v, 'w') as f:
+            f.write(self.verilog)
+
+        harness_cpp = os.path.join(self.build_dir, 'harness.cpp')
+        with open(harness_cpp, 'w') as f:
+            divisor = (self.clk_freq + (self.baud // 2)) // self.baud
+            f.write(HARNESS.format(divisor=divisor))
+
+        subprocess.run([
+            verilator,
+            '--cc', '--exe', '--build',
+            '-O3', '-Wno-fatal',
+            '--top-module', 'top',
+            '-Mdir', os.path.join(self.build_dir, 'obj'),
+            '-o', 'risky-sim',
+            top_v, harness_cpp,
+        ], check=True, stdout=subprocess.DEVNULL)
+
+        return self.binary
+
+    def run(self, cycles=None, boot=True):
+        if cycles is None:
+            cycles = -1
+
+        subprocess.run([self.binary, str(cycles), str(int(boot))], check=True)
@@ -0,0 +1,20 @@
+import risky.test
+
+class Counters(risky.test.ProgramTest):
+    REQUIRES = ('zicsr', 'zicntr')
+
+    PROGRAM = """
+    csrr a0, cycle
+    csrr a1, instret
+    nop
+    nop
+    csrr a2, instret
+    csrr a3, time
+    sub a4, a2, a1
+    sltu a5, a0, a3
+    a:
+    """
+
+    CHECKPOINTS = [
+        ('a', {'a4': 3, 'a5': 1}),
+    ]